@@ -0,0 +1,80 @@
+'''
+	Slate - Google Calendar Sync
+	Startup benchmark
+
+	Measures how long it takes to import slatesync.py and to print the command line help. Each
+	measurement starts a new Python interpreter, so the numbers include interpreter startup. An
+	empty interpreter is timed as a baseline.
+
+	Usage:
+		python benchmarks/bench_startup.py [--runs 20] [--importtime]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Libraries only the sync itself needs. None of these should be loaded by importing slatesync.py.
+DEFERRED_MODULES = ['googleapiclient', 'apiclient', 'oauth2client', 'httplib2', 'requests', 'pytz', 'smtplib']
+
+COMMANDS = [
+	('python (baseline)', [sys.executable, '-c', 'pass']),
+	('import slatesync', [sys.executable, '-c', 'import slatesync']),
+	('slatesync.py -h', [sys.executable, 'slatesync.py', '-h']),
+]
+
+def timeCommand(command, runs):
+	times = []
+	for i in range(runs):
+		started = time.perf_counter()
+		subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+		times.append(time.perf_counter() - started)
+	return times
+
+def loadedModules():
+	check = 'import sys, slatesync; print(" ".join(m for m in ' + repr(DEFERRED_MODULES) + ' if m in sys.modules))'
+	result = subprocess.run([sys.executable, '-c', check], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+	return result.stdout.split()
+
+def importTime(count=15):
+	'''Returns the modules with the largest cumulative import time reported by python -X importtime'''
+	result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import slatesync'], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+
+	imports = []
+	for line in result.stderr.splitlines():
+		# Format: import time: self [us] | cumulative | imported package
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		fields = line[len('import time:'):].split('|')
+		imports.append((int(fields[1]), fields[2].strip()))
+
+	return sorted(imports, reverse=True)[:count]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Slate - Google Calendar Sync startup benchmark')
+	parser.add_argument('--runs', type=int, default=20, help='Number of times to run each command (default: 20)')
+	parser.add_argument('--importtime', action='store_true', help='Also show the slowest imports reported by python -X importtime')
+	flags = parser.parse_args()
+
+	print('%-20s %10s %10s %10s' % ('command', 'median ms', 'min ms', 'max ms'))
+	for name, command in COMMANDS:
+		times = timeCommand(command, flags.runs)
+		print('%-20s %10.1f %10.1f %10.1f' % (name, statistics.median(times) * 1000, min(times) * 1000, max(times) * 1000))
+
+	loaded = loadedModules()
+	print()
+	print('Deferred libraries loaded by import slatesync:', ', '.join(loaded) if loaded else 'none')
+
+	if flags.importtime:
+		print()
+		print('%12s  %s' % ('cumulative us', 'module'))
+		for cumulative, module in importTime():
+			print('%12d  %s' % (cumulative, module))
+
+	# Fail if a deferred library is imported at module level again
+	sys.exit(1 if loaded else 0)
@@ -21,104 +21,201 @@
 			
 '''
 
-import httplib2
 import os
 import argparse
 import json
 import sys
 import time
-import requests
 import html
 import configparser
 import threading
+import queue
 import time
 import urllib
+import uuid
+import secrets
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import concurrent.futures
+import contextlib
+import atexit
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from urllib.parse import urlparse
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from pprint import pprint
 from datetime import date, datetime, timedelta
-from os import curdir, sep
 
-# Email libraries
-import smtplib
-from email.mime.text import MIMEText
+# Google, Slate, timezone and email libraries are imported by the functions that use them so that
+# command line operations that don't need them (-h, -d) start quickly. See benchmarks/bench_startup.py.
 
-# Timezone Library
-from pytz import timezone
-import pytz
+logger = logging.getLogger('slate_sync')
 
-# Google libraries
-from apiclient import discovery
-from googleapiclient.errors import HttpError
-import oauth2client
-from oauth2client import client
-from oauth2client import tools
-from oauth2client import file
+SCOPES = 'https://www.googleapis.com/auth/calendar https://www.googleapis.com/auth/userinfo.email'
+APPLICATION_NAME = 'Union College Slate-Google Calendar Sync'
 
-# Read Configuration File
+# Currently if an interview is cancelled the slot stays assigned to the person. To accomodate this we'll prefix empty slots with "Potential"
+ONCAMPUS_INTERVIEW_TEXT_NOT_ASSIGNED = 'On Campus Interview'
 
-try:
-	config = configparser.ConfigParser()
-	config.read('config.ini')
+# Set by init()
+flags = None
+calendars = {}
 
-	logFileName = config['Files']['LogFile']	
-	CLIENT_SECRET_FILE = config['Files']['ClientSecretFile']
+def init(args=None):
+	'''Parses the command line, reads config.ini, starts logging and loads the calendar list'''
+	global flags, mailer, googleRateLimiter, journal, calendarBreaker, duplicateCompactor, cProfilePending
 	
-	logDays = int(config['Logging']['LogDaysArchive'])
-	logLevel = config['Logging']['LogLevel']
-	logModuleLevel = logging.getLevelName(logLevel)
-
-	pastDays = int(config['CalendarSyncing']['NumberOfPriorDays'])
-	futureDays = int(config['CalendarSyncing']['NumberOfFutureDays'])
-	syncInterval = int(config['CalendarSyncing']['SyncInterval'])
-
-	emailFrom = config['Emails']['EmailFromAddress']
-	emailTo = config['Emails']['ErrorEmailAddress'].split(',')
-	emailEventChanges = config['Emails'].getboolean('EmailEventChanges')
-	mailServer = config['Emails']['MailServer']
+	# Parse the command line first so -h doesn't need a configuration file
+	flags = parseArguments(args)
+	loadConfig()
+	startLogging()
+	startProfiling()
+	loadCalendars()
+	loadWatchChannels()
 	
-	syncServer = config['Servers']['SyncServer']
-	syncServerPort = config['Servers']['syncServerPort']
-	slateServer = config['Servers']['SlateServer']
-	slateEventWebService = config['Servers']['SlateEventWebService']
-	slateEventWebServiceStops = config['Servers']['SlateEventWebServiceStops']
-	slateEventWebServiceUsername = config['Servers']['SlateEventWebServiceUsername']
-	slateEventWebServicePassword = config['Servers']['SlateEventWebServicePassword']
+	mailer = Mailer(mailServer, emailDigestPeriod, emailRetries, emailRetryBackoff)
+	googleRateLimiter = RateLimiter(googleApiRateLimit)
+	journal = MutationJournal(journal_file, mutationJournal)
+	calendarBreaker = CircuitBreaker(circuitBreakerInterval, circuitBreakerMaxInterval)
+	duplicateCompactor = DuplicateCompactor(duplicateBatchSize, duplicateBatchInterval)
 	
-	syncServerUrl = syncServer
+	# Only the first full sync is profiled with cProfile
+	cProfilePending = flags.cprofile
 
-	
-	openInterviewLabel = config['Settings']['OpenInterviewLabel']
-	onCampusInterviewLocation = config['Settings']['OnCampusInterviewLocation']
-	googleApiBackoff = config['Settings']['GoogleApiBackoff']
-	
-except KeyError as err:
-	print ("Unsuccessful read of configuration file config.ini")
-	print (format(err))
-	sys.exit()
+# Read Configuration File
+def loadConfig(configFile='config.ini'):
+	global config, logFileName, CLIENT_SECRET_FILE, logDays, logLevel, logModuleLevel, pastDays, futureDays
+	global syncInterval, pushNotifications, safetySyncInterval, watchChannelTtl, syncRequestWindow, hotWindowDays
+	global circuitBreakerInterval, circuitBreakerMaxInterval
+	global coldSyncInterval, pipelineDepth, emailFrom, emailTo, emailEventChanges, mailServer, emailDigestPeriod
+	global emailRetries, emailRetryBackoff, syncServer, syncServerPort, slateServer, slateEventWebService
+	global slateEventWebServiceStops, slateEventWebServiceUsername, slateEventWebServicePassword, triggerToken
+	global syncServerUrl, openInterviewLabel, onCampusInterviewLocation, googleApiBackoff, googleApiRateLimit
+	global clearWorkers, clearBatchSize, mutationJournal, duplicateBatchSize, duplicateBatchInterval, profilingEnabled
+	global memoryTracking
+
+	try:
+		config = configparser.ConfigParser()
+		config.read(configFile)
+
+		logFileName = config['Files']['LogFile']	
+		CLIENT_SECRET_FILE = config['Files']['ClientSecretFile']
+		
+		logDays = int(config['Logging']['LogDaysArchive'])
+		logLevel = config['Logging']['LogLevel']
+		logModuleLevel = logging.getLevelName(logLevel)
+
+		pastDays = int(config['CalendarSyncing']['NumberOfPriorDays'])
+		futureDays = int(config['CalendarSyncing']['NumberOfFutureDays'])
+		syncInterval = int(config['CalendarSyncing']['SyncInterval'])
+		pushNotifications = config['CalendarSyncing'].getboolean('PushNotifications', fallback=False)
+		safetySyncInterval = int(config['CalendarSyncing'].get('SafetySyncInterval', '3600'))
+		watchChannelTtl = int(config['CalendarSyncing'].get('WatchChannelTTL', '604800'))
+		syncRequestWindow = int(config['CalendarSyncing'].get('SyncRequestWindow', '10'))
+		hotWindowDays = int(config['CalendarSyncing'].get('HotWindowDays', '0'))
+		coldSyncInterval = int(config['CalendarSyncing'].get('ColdSyncInterval', '3600'))
+		pipelineDepth = int(config['CalendarSyncing'].get('PipelineDepth', '0'))
+		circuitBreakerInterval = int(config['CalendarSyncing'].get('CircuitBreakerInterval', '0'))
+		circuitBreakerMaxInterval = int(config['CalendarSyncing'].get('CircuitBreakerMaxInterval', '86400'))
+
+		emailFrom = config['Emails']['EmailFromAddress']
+		emailTo = config['Emails']['ErrorEmailAddress'].split(',')
+		emailEventChanges = config['Emails'].getboolean('EmailEventChanges')
+		mailServer = config['Emails']['MailServer']
+		emailDigestPeriod = int(config['Emails'].get('EmailDigestPeriod', '0'))
+		emailRetries = int(config['Emails'].get('EmailRetries', '5'))
+		emailRetryBackoff = int(config['Emails'].get('EmailRetryBackoff', '30'))
+		
+		syncServer = config['Servers']['SyncServer']
+		syncServerPort = config['Servers']['syncServerPort']
+		slateServer = config['Servers']['SlateServer']
+		slateEventWebService = config['Servers']['SlateEventWebService']
+		slateEventWebServiceStops = config['Servers']['SlateEventWebServiceStops']
+		slateEventWebServiceUsername = config['Servers']['SlateEventWebServiceUsername']
+		slateEventWebServicePassword = config['Servers']['SlateEventWebServicePassword']
+		triggerToken = config['Servers'].get('TriggerToken', '')
+		
+		syncServerUrl = syncServer
+
+		
+		openInterviewLabel = config['Settings']['OpenInterviewLabel']
+		onCampusInterviewLocation = config['Settings']['OnCampusInterviewLocation']
+		googleApiBackoff = config['Settings']['GoogleApiBackoff']
+		googleApiRateLimit = float(config['Settings'].get('GoogleApiRateLimit', '0'))
+		clearWorkers = int(config['Settings'].get('ClearWorkers', '8'))
+		clearBatchSize = int(config['Settings'].get('ClearBatchSize', '500'))
+		mutationJournal = config['Settings'].getboolean('MutationJournal', fallback=True)
+		duplicateBatchSize = int(config['Settings'].get('DuplicateBatchSize', '50'))
+		duplicateBatchInterval = float(config['Settings'].get('DuplicateBatchInterval', '1'))
+		
+		profilingEnabled = config.getboolean('Profiling', 'Enabled', fallback=False)
+		memoryTracking = config.getboolean('Profiling', 'MemoryTracking', fallback=False)
+		
+	except KeyError as err:
+		print ("Unsuccessful read of configuration file", configFile)
+		print (format(err))
+		sys.exit()
 
 
 # Start Logging
-log_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logs')
-if not os.path.exists(log_dir):
-	os.makedirs(log_dir)
-logPath = os.path.join(log_dir, logFileName)
+def startLogging():
+	global logPath
+	
+	log_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logs')
+	if not os.path.exists(log_dir):
+		os.makedirs(log_dir)
+	logPath = os.path.join(log_dir, logFileName)
 
-logger = logging.getLogger('slate_sync')
-logger.setLevel(logModuleLevel)
+	logger.setLevel(logModuleLevel)
+
+	formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+	handler = TimedRotatingFileHandler(logPath, when='midnight', interval=1, backupCount=logDays)
+	handler.setLevel(logModuleLevel)
+	handler.setFormatter(formatter)
+	logger.addHandler(backgroundHandler(handler))
 
-handler = TimedRotatingFileHandler(logPath, when='midnight', interval=1, backupCount=logDays)
-handler.setLevel(logModuleLevel)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# Log files are written by background threads so syncing never waits on the disk
+logListeners = []
 
-try:
-	import argparse
-	parser = argparse.ArgumentParser(description='Union College Slate - Google Calendar Sync',epilog="Created by David Glasser at Union College", parents=[tools.argparser])
+def backgroundHandler(handler):
+	'''Returns a handler that queues records for handler to write in a background thread'''
+	records = queue.Queue()
+	listener = QueueListener(records, handler, respect_handler_level=True)
+	listener.start()
+	logListeners.append(listener)
+	
+	queueHandler = QueueHandler(records)
+	queueHandler.setLevel(handler.level)
+	return queueHandler
+
+@atexit.register
+def stopLogging():
+	'''Writes queued log records and stops the background log writers'''
+	while logListeners:
+		logListeners.pop().stop()
+
+def eventSummary(events, limit=10):
+	'''Describes a dict of events by count and the first few ids, for logging at INFO without writing every event'''
+	ids = list(events)[:limit]
+	summary = str(len(events)) + ' events'
+	if ids:
+		summary += ': ' + ', '.join(str(id) for id in ids)
+	if len(events) > limit:
+		summary += ' and ' + str(len(events) - limit) + ' more'
+	return summary
+
+def parseArguments(args=None):
+	parser = argparse.ArgumentParser(description='Union College Slate - Google Calendar Sync',epilog="Created by David Glasser at Union College")
+	
+	# The same arguments as oauth2client.tools.argparser, which tools.run_flow() expects. They are repeated here so
+	# that parsing the command line doesn't import oauth2client.
+	parser.add_argument('--auth_host_name', default='localhost',
+                    help='Hostname when running a local web server.')
+	parser.add_argument('--noauth_local_webserver', action='store_true', default=False,
+                    help='Do not run a local web server.')
+	parser.add_argument('--auth_host_port', default=[8080, 8090], type=int, nargs='*',
+                    help='Port web server should listen on.')
+	parser.add_argument('--logging_level', default='ERROR', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                    help='Set the logging level of detail.')
+	
 	group = parser.add_mutually_exclusive_group()
 	group.add_argument("-d", "--delete", type=str, metavar='email_address',
                     help="Delete Google calendar")
@@ -126,40 +223,87 @@ try:
                     help="Clear all Slate events from Google calendar")
 	group.add_argument("-s", "--sync", type=str, metavar='email_address',
                     help="Sync a single existing calendar")	
-	flags = parser.parse_args()
+	group.add_argument("-p", "--plan", type=str, nargs='?', const='', metavar='email_address',
+                    help="Write the changes a sync would make to a JSON file without making them. Plans every calendar if no email address is given")
+	parser.add_argument("--plan-file", type=str, default='sync_plan.json', metavar='file',
+                    help="File the sync plan is written to (default: sync_plan.json)")
+	parser.add_argument("--profile", action='store_true',
+                    help="Write the time spent in each phase of a sync to the traces directory")
+	parser.add_argument("--cprofile", action='store_true',
+                    help="Profile the first full sync with cProfile and save the stats to the traces directory")
 	
-except ImportError:
-	flags = None
-	logger.warning('Failed to capture command line arguments.')
+	return parser.parse_args(args)
 
-SCOPES = 'https://www.googleapis.com/auth/calendar https://www.googleapis.com/auth/userinfo.email'
-APPLICATION_NAME = 'Union College Slate-Google Calendar Sync'
+# Start Profiling
+# Phase timings are written in the folded stack format read by flame graph tools (flamegraph.pl, speedscope)
+trace_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'traces')
 
-# Currently if an interview is cancelled the slot stays assigned to the person. To accomodate this we'll prefix empty slots with "Potential"
-ONCAMPUS_INTERVIEW_TEXT_NOT_ASSIGNED = 'On Campus Interview'
+traceLogger = logging.getLogger('slate_sync.trace')
+traceLogger.propagate = False
+traceLogger.setLevel(logging.INFO)
+
+tracing = False
+memoryTracking = False
+
+# Spans open in each thread
+spanStacks = threading.local()
+
+# Only the first full sync is profiled with cProfile
+cProfilePending = False
+
+def startProfiling():
+	global tracing
+	
+	tracing = profilingEnabled or flags.profile
+	if tracing or flags.cprofile:
+		if not os.path.exists(trace_dir):
+			os.makedirs(trace_dir)
+
+	if memoryTracking:
+		import tracemalloc
+		tracemalloc.start()
+
+	if tracing:
+		traceHandler = TimedRotatingFileHandler(os.path.join(trace_dir, 'slatesync.folded'), when='midnight', interval=1, backupCount=logDays)
+		traceHandler.setFormatter(logging.Formatter('%(message)s'))
+		traceLogger.addHandler(backgroundHandler(traceHandler))
 
 # Get credentials
-# Check to see if credentials directory exists
 credential_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'credentials')
-if not os.path.exists(credential_dir):
-	os.makedirs(credential_dir)
 
-# Check to see if master list of calendars exists
+# Progress of long running operations
+checkpoint_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'checkpoints')
+journal_file = os.path.join(checkpoint_dir, 'mutations.journal')
+watch_channel_file = os.path.join(checkpoint_dir, 'watch_channels.json')
+
 calendar_list_file = 'calendar_list.json'
-if not os.path.isfile(calendar_list_file):
-	f = open(calendar_list_file, 'w')
-	calendars = {}
-	json.dump(calendars, f)
+
+def loadCalendars():
+	global calendars
+	
+	# Check to see if credentials directory exists
+	if not os.path.exists(credential_dir):
+		os.makedirs(credential_dir)
+
+	# Check to see if master list of calendars exists
+	if not os.path.isfile(calendar_list_file):
+		f = open(calendar_list_file, 'w')
+		calendars = {}
+		json.dump(calendars, f)
+		f.close()
+
+	# Open calendar list
+	f = open(calendar_list_file, 'r')
+	calendars = json.load(f)
 	f.close()
+	logger.info('Found %s calendars', len(calendars))
+	logger.debug('Found the following calendars: %s', calendars)
 
-# Open calendar list
-f = open(calendar_list_file, 'r')
-calendars = json.load(f)
-f.close()
-logger.info('Found the following calendars: %s', calendars)
+# Time each calendar last synced its full window
+coldWindowSyncTimes = {}
 
 
-def main():
+def main(syncCalendars=None, planOnly=False):
 	
 	currentThread = threading.current_thread()
 
@@ -167,263 +311,971 @@ def main():
 	logger.debug('Log level set to: %s', logger.getEffectiveLevel())
 	
 	errors = []
+	plans = []
 	
-	# Calculate sync windowBegin
-	windowBegin = datetime.now(pytz.utc) - timedelta(days=pastDays)
-	windowBegin = windowBegin.replace(hour=0, minute=0, second=0, microsecond=0)
-	windowEnd = datetime.now(pytz.utc) + timedelta(days=futureDays)
-	windowEnd = windowEnd.replace(hour=0, minute=0, second=0, microsecond=0)
-	windowGrace = datetime.now(pytz.utc) - timedelta(days=pastDays-1)
-	windowGrace = windowGrace.replace(hour=0, minute=0, second=0, microsecond=0)
-	logger.info('Setting sync window. Window Begin: %s Window End: %s Window Grace: %s', windowBegin, windowEnd, windowGrace)
+	window = syncWindow()
 	
+	selectedCalendars = []
 
 	# Loop through calendars
-	for googleCalendar, calendarInfo in calendars.items():
-		slateCalendar = googleCalendar
-		try:
-			eventColorOnCampus = calendarInfo['eventColorOnCampus']
-		except:
-			eventColorOnCampus = ''
-		try:
-			eventColorOther = calendarInfo['eventColorOther']
-		except:
-			eventColorOther = ''
+	for googleCalendar, calendarInfo in list(calendars.items()):
 	
 		# Check to make sure that a single calendar sync wasn't requested
-		if flags.sync is not None:
+		if flags is not None and flags.sync is not None:
 			sync_calendar = (flags.sync).strip()
 			
 			if googleCalendar != sync_calendar:
 				continue #go to beginning of loop
+
+		# Check to see if only specific calendars were queued for sync
+		if syncCalendars is not None and googleCalendar not in syncCalendars:
+			continue
+		
+		selectedCalendars.append((googleCalendar, calendarInfo))
 	
-		logger.info('Syncing events for calendar: %s', googleCalendar)
-		print('Syncing events for calendar: ', googleCalendar)
+	if syncCalendars is None:
+		cycleName = 'cycle'
+	else:
+		cycleName = 'targeted'
 	
-		credential_file = googleCalendar + '.json'
-		credential_path = os.path.join(credential_dir, credential_file)
-		store = oauth2client.file.Storage(credential_path)
-		credentials = store.get()
-				
-		if not credentials or credentials.invalid:
-			# Try to refresh credentials
-			try:
-				logger.info ('Attempting to refresh credentials for calendar: %s ', googleCalendar)
-				credentials = credentials.refresh(httplib2.Http())
-			except Exception as e:
-				logger.error ('Exception caught while refreshing credentials: %s', e)
-			if not credentials or credentials.invalid:
-				logger.error ('Google Calendar: %s could not synced. No valid OAuth Token. Have user reauthenticate.', googleCalendar)
-				logger.info ('credential_file: %s credential_path: %s', credential_file, credential_path)
-				logger.info ('credentials: %s ', credentials)
-				errors.append ('Google Calendar: ' + googleCalendar + ' could not synced. No valid OAuth Token. Have user reauthenticate.')
+	cyclePeak = recordMemory('start')
+	
+	with span(cycleName):
+		if pipelineDepth > 0:
+			calendarPlans = pipelinePlans(selectedCalendars, window, errors, planOnly)
 		else:
-			logger.info('Retrieved valid credentials for calendar: %s', googleCalendar)
+			calendarPlans = sequentialPlans(selectedCalendars, window, errors, planOnly)
 		
-			http = credentials.authorize(httplib2.Http(timeout=15))
-			service = discovery.build('calendar', 'v3', http=http, cache_discovery=False)
+		for service, plan in calendarPlans:
+			if planOnly:
+				plans.append(plan)
+			else:
+				executePlan(service, plan, errors)
 			
-			# Get users events
-			googleEvents = readGoogleCalendar(service, googleCalendar, windowBegin, windowEnd)
-			logger.info ('Google Calendar: %s Slate events in Google Calendar: %s', googleCalendar, googleEvents)
-			googleEventKeys = list(googleEvents.keys())
+			# Only one calendar's events are kept at a time. Release them before the next calendar is read.
+			googleCalendar = plan['calendar']
+			del service, plan
+			cyclePeak = max(cyclePeak, recordMemory(googleCalendar))
+	
+	if memoryTracking:
+		recordMemory('cycle')
+		logger.info ('Memory: Sync of %s calendars. Peak: %s KB', len(selectedCalendars), cyclePeak // 1024)
+	
+	if planOnly:
+		for error in errors:
+			print (error)
+		logger.info('Finish SlateSync plan')
+		return plans
+	
+	#Send email if error occured
+	if (len(errors) > 0):
+		mailer.send(emailTo, 'Slate-Google Sync Errors', errors)
+	
+	#Finish
+	logger.info('Finish SlateSync')
+
+def sequentialPlans(selectedCalendars, window, errors, planOnly):
+	for googleCalendar, calendarInfo in selectedCalendars:
+		# A calendar that can't be read or planned is skipped, the rest are still synced
+		try:
+			calendarData = readCalendar(googleCalendar, calendarInfo, window, errors, planOnly)
+			if calendarData is None:
+				continue
 			
-			# Get Slate events
+			service = calendarData['service']
+			plan = planCalendar(calendarData)
+		except Exception as e:
+			logger.error ('Google Calendar: %s Unhandled exception while reading calendar.', googleCalendar)
+			logger.exception(e)
+			errors.append ('Google Calendar: ' + googleCalendar + ' could not be synced. Exception: ' + str(e))
+			continue
+		
+		# The plan has everything needed to execute it. Don't hold every event while it executes.
+		del calendarData
+		yield service, plan
+		
+		# This frame is suspended at the yield, so its references would keep the plan alive while the next calendar is read
+		service = plan = None
+
+def pipelinePlans(selectedCalendars, window, errors, planOnly):
+	'''Reads and plans calendars in background threads while the caller executes the plans it has already received.
+	
+	Calendar N+1 is read from Google and Slate while calendar N's changes are being made. Each queue between stages
+	holds at most PipelineDepth calendars, so a slow stage holds back the ones before it instead of letting events pile up in memory.
+	'''
+	readQueue = queue.Queue(maxsize=pipelineDepth)
+	planQueue = queue.Queue(maxsize=pipelineDepth)
+	traceRoot = currentSpan()
+	finished = object()
+	stopped = threading.Event()
+	
+	def put(stageQueue, item):
+		# Give up if the caller stopped taking plans so threads never block forever
+		while not stopped.is_set():
 			try:
-				slateEvents = readSlateCalendarWebService(googleCalendar, slateEventWebService, slateEventWebServiceStops, slateEventWebServiceUsername, slateEventWebServicePassword, windowBegin, windowEnd)
-			except:
-				print ('Unable to retrieve Slate Calendar ', slateCalendar)
-			else:
-				logger.info ('Google Calendar: %s Slate events in Slate: %s', googleCalendar, slateEvents)
+				stageQueue.put(item, timeout=1)
+				return True
+			except queue.Full:
+				pass
+		return False
+	
+	def get(stageQueue):
+		# The previous stage may stop without sending finished if the caller stopped taking plans
+		while not stopped.is_set():
+			try:
+				return stageQueue.get(timeout=1)
+			except queue.Empty:
+				pass
+		return finished
+	
+	def reader():
+		try:
+			with span(traceRoot):
+				for googleCalendar, calendarInfo in selectedCalendars:
+					# A calendar that can't be read is skipped, the rest are still synced
+					try:
+						calendarData = readCalendar(googleCalendar, calendarInfo, window, errors, planOnly)
+					except Exception as e:
+						logger.error ('Pipeline: Google Calendar: %s Unhandled exception while reading calendar.', googleCalendar)
+						logger.exception(e)
+						errors.append ('Google Calendar: ' + googleCalendar + ' could not be synced. Exception: ' + str(e))
+						continue
+					
+					if calendarData is not None and not put(readQueue, calendarData):
+						return
+					
+					# Don't hold this calendar's events while the next one is read
+					calendarData = None
+		finally:
+			put(readQueue, finished)
+	
+	def planner():
+		try:
+			while True:
+				calendarData = get(readQueue)
+				if calendarData is finished:
+					break
 				
-				# Store changes
-				calendarModifications = []
+				try:
+					with span(traceRoot):
+						plan = planCalendar(calendarData)
+				except Exception as e:
+					logger.error ('Pipeline: Google Calendar: %s Unhandled exception while planning calendar.', calendarData['calendar'])
+					logger.exception(e)
+					errors.append ('Google Calendar: ' + calendarData['calendar'] + ' could not be synced. Exception: ' + str(e))
+					continue
 				
-				# Compare differences and make updates
-				for eventId, eventDetails in slateEvents.items(): # Iterate over Slate Events
+				# Don't hold every event while waiting for the plan to be taken
+				service = calendarData['service']
+				del calendarData
 				
-					try:
-					
-						if (eventId in googleEvents): #Check if event exists in Google Calendar
-							logger.debug('Event %s from calendar %s already exists in Google Calendar. Look for changes.', eventId, googleCalendar)
+				if not put(planQueue, (service, plan)):
+					return
+				del service, plan
+		finally:
+			put(planQueue, finished)
+	
+	threads = [threading.Thread(target=reader, name='PipelineReader'), threading.Thread(target=planner, name='PipelinePlanner')]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	
+	try:
+		while True:
+			item = planQueue.get()
+			if item is finished:
+				break
+			yield item
+			
+			# Release the executed plan before waiting for the next one
+			item = None
+	finally:
+		stopped.set()
 
-							googleEvent = googleEvents[eventId]
-							googleEventKeys.remove(eventId)							
-							
-							# Determine if event is on campus
-							onCampusEvent = False
-							if (eventDetails['location'].startswith(onCampusInterviewLocation)):
-								onCampusEvent = True
-								
-							#Set eventColor
-							if (onCampusEvent):
-								eventColor = eventColorOnCampus
-							else: 
-								eventColor = eventColorOther
-							
-							# Check if event has changed
-							summaryChange = False
-							if (googleEvent['summary'] != eventDetails['summary']):
-								summaryChange = True
-
-							# Check to see if the attendee count changed
-							attendeeChange = False
-							if (summaryChange and eventDetails['type'].lower() == 'event'):
-								googleEventIndex = googleEvent['summary'].rfind('(')
-								slateEventIndex = eventDetails['summary'].rfind('(')
-								if (googleEvent['summary'][0:googleEventIndex] == eventDetails['summary'][0:slateEventIndex]):
-									logger.debug ('Event attendance has changed. Event ID: %s', eventId)
-									attendeeChange = True
-									
-
-							# Check for location change
-							
-							locationChange = False
-							if (googleEvent['location'] != eventDetails['location']):
-								locationChange = True
-							
-							startChange = False
-							if (googleToDateTime(googleEvent['start']) != eventDetails['start']):
-								startChange = True
-							
-							colorChange = False
-							if (googleEvent['colorId'] != eventColor):
-								colorChange = True
+def syncWindow():
+	import pytz
+	
+	# Calculate sync windowBegin
+	windowBegin = datetime.now(pytz.utc) - timedelta(days=pastDays)
+	windowBegin = windowBegin.replace(hour=0, minute=0, second=0, microsecond=0)
+	windowEnd = datetime.now(pytz.utc) + timedelta(days=futureDays)
+	windowEnd = windowEnd.replace(hour=0, minute=0, second=0, microsecond=0)
+	windowGrace = datetime.now(pytz.utc) - timedelta(days=pastDays-1)
+	windowGrace = windowGrace.replace(hour=0, minute=0, second=0, microsecond=0)
+	hotWindowEnd = windowEnd
+	if hotWindowDays > 0:
+		hotWindowEnd = min(windowEnd, (datetime.now(pytz.utc) + timedelta(days=hotWindowDays)).replace(hour=0, minute=0, second=0, microsecond=0))
+	logger.info('Setting sync window. Window Begin: %s Window End: %s Hot Window End: %s Window Grace: %s', windowBegin, windowEnd, hotWindowEnd, windowGrace)
+	
+	return {
+		'begin'		: windowBegin,
+		'end'		: windowEnd,
+		'hotEnd'	: hotWindowEnd,
+		'grace'		: windowGrace,
+	}
 
-							descriptionChange = False
-							if (googleEvent['description'] != eventDetails['description']):
-								descriptionChange = True
+class CircuitBreaker:
+	'''Skips calendars that keep failing so they don't cost network calls and error emails every sync.
+	
+	A calendar starts closed and is synced normally. A failure opens it: it is skipped until its retry time, which
+	doubles with every failure in a row from baseInterval up to maxInterval. After the retry time one half-open probe
+	sync is allowed. If it succeeds the calendar closes again. Only the failure that opens a closed calendar is
+	reported. A baseInterval of 0 turns the breaker off.
+	'''
+	
+	def __init__(self, baseInterval, maxInterval):
+		self.baseInterval = baseInterval
+		self.maxInterval = maxInterval
+		self.lock = threading.Lock()
+		self.breakers = {}
+	
+	def allow(self, calendar):
+		'''Returns True if the calendar should be synced now'''
+		with self.lock:
+			breaker = self.breakers.get(calendar)
+			if breaker is None:
+				return True
+			
+			if time.time() < breaker['retryAt']:
+				return False
+			
+			# Allow one probe. If it never reports back another is allowed after the same interval.
+			breaker['state'] = 'half-open'
+			breaker['retryAt'] = time.time() + breaker['interval']
+			return True
+	
+	def success(self, calendar):
+		with self.lock:
+			breaker = self.breakers.pop(calendar, None)
 		
-							## Check to see if the end of the event changed. 
-							endChange = False
-							
-							# Slate does not return end date for all day events
-							if ( type(eventDetails['start']) == date and eventDetails['end'] == '' ): 
-								endChange = False
-								
-							# Check to see if the start date is of type datetime but the end date is of type date. If so, make sure event is one hour long
-							elif ( type(eventDetails['start']) == datetime and type(eventDetails['end']) == date and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1))):
-								endChange = False
-							
-							# No end time in Google, make sure end time is 1 hour after start time
-							elif ( eventDetails['end'] == '' and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1)) ):
-								endChange = False
-								
-							# Check to see if Google has end time by Slate does not
-							elif ( eventDetails['end'] == '' and googleEvent['end'] != ''):
-								endChange = True
-								
-							# Check to see if the event ends before it starts. If so, make sure end time is 1 hour after start time
-							elif (eventDetails['end'] < eventDetails['start']  and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1)) ):
-								endChange = False
-							
-							elif (googleToDateTime(googleEvent['end']) != eventDetails['end']):
-								endChange = True
-							
-							# Check to see if event changed
-							if (summaryChange or locationChange or startChange or endChange or colorChange or descriptionChange):
-								logger.debug ('Event has changed. summaryChange: %s locationChange: %s descriptionChange: %s startChange: %s endChange: %s colorChange: %s', summaryChange, locationChange, descriptionChange, startChange, endChange, colorChange)
-								logger.debug(eventId, eventDetails)
-								
-								logger.debug ('Slate Summary   %s', eventDetails['summary'])
-								logger.debug ('Google Summary  %s', googleEvent['summary'])
-								logger.debug ('Slate location  %s', eventDetails['location'])
-								logger.debug ('Google location %s', googleEvent['location'])
-								logger.debug ('Slate start     %s %s', eventDetails['start'], type(eventDetails['start']))
-								logger.debug ('Google start    %s %s', googleEvent['start'], type(googleEvent['start']))
-								logger.debug ('Slate end       %s %s', eventDetails['end'], type(eventDetails['end']))
-								logger.debug ('Google end      %s %s', googleEvent['end'], type(googleEvent['end']))
-								logger.debug ('Window grace    %s', windowGrace)
-								
-								
-
-								#Event has changed. Delete old event and recreate.							
-								deleteError = deleteEvent(service, googleApiBackoff, googleCalendar, googleEvent['eventId'])
-								if (deleteError != ''):
-									errors.append(deleteError)
-								
-								addError = addEvent(service, googleCalendar, eventId, eventDetails['summary'], eventDetails['location'], eventDetails['description'], eventDetails['start'], eventDetails['end'], eventColor)
-								if (addError != ''):
-									errors.append(addError)
-
-								# Only send notification if summary or time change
-								if ((summaryChange and eventDetails['type'].lower() == 'interview') or (summaryChange and not attendeeChange) or startChange):										
-									calendarModifications.append('Deleting event: ' + googleToDateTime(googleEvent['start'], False).strftime("%B %d, %Y %I:%M %p")  + ' - ' +  googleEvents[eventId]['summary'])
-									calendarModifications.append('Adding event: ' + formatDate(eventDetails['start']) + ' - ' + eventDetails['summary'])
-							
-							
-						else:
-							logger.debug('Event %s from calendar %s does not exists in Google Calendar. Add event.', eventId, googleCalendar)
-							
-							# Determine if event is on campus
-							onCampusEvent = False
-							if (eventDetails['location'].startswith(onCampusInterviewLocation)):
-								onCampusEvent = True
-								
-							#Set eventColor
-							if (onCampusEvent):
-								eventColor = eventColorOnCampus
-							else: 
-								eventColor = eventColorOther
-							
-							addError = addEvent(service, googleCalendar, eventId, eventDetails['summary'], eventDetails['location'], eventDetails['description'], eventDetails['start'], eventDetails['end'], eventColor)
-							calendarModifications.append('Adding event: ' + formatDate(eventDetails['start']) + ' - ' + eventDetails['summary'])
-							if (addError != ''):
-								errors.append(addError)
-								
-					except Exception as e:
-							logger.error ('Error processing event. Event ID: : %s', eventId)
-							logger.exception(e)
-					
-				#Remove Google Events that are no longer present in Slate Calendar				
-				for eventId in googleEventKeys:
-					try:
-						start = googleToDateTime(googleEvents[eventId]['start'], False)
-						if (isinstance(start, datetime)):
-							start = start.date()
-							
-						if (start < windowGrace.date()):
-							logger.debug('Event %s from calendar %s occurs during grace period. Make no changes to event.', eventId, googleCalendar)
+		if breaker is not None:
+			logger.info ('Circuit breaker: Google Calendar: %s Closed after %s failures', calendar, breaker['failures'])
+	
+	def failure(self, calendar, reason):
+		'''Opens the calendar's breaker. Returns True if the calendar was syncing normally before this failure.'''
+		if self.baseInterval <= 0:
+			return True
+		
+		with self.lock:
+			breaker = self.breakers.setdefault(calendar, {'failures': 0})
+			breaker['failures'] += 1
+			breaker['interval'] = min(self.baseInterval * 2 ** (breaker['failures'] - 1), self.maxInterval)
+			breaker['retryAt'] = time.time() + breaker['interval']
+			breaker['state'] = 'open'
+			breaker['reason'] = reason
+			failures = breaker['failures']
+		
+		logger.warning ('Circuit breaker: Google Calendar: %s Open after %s failures (%s). Next attempt in %s seconds.', calendar, failures, reason, breaker['interval'])
+		return failures == 1
+	
+	def reset(self, calendar):
+		'''Closes the calendar's breaker, for example after the user re-authenticates'''
+		with self.lock:
+			breaker = self.breakers.pop(calendar, None)
+		
+		if breaker is not None:
+			logger.info ('Circuit breaker: Google Calendar: %s Reset', calendar)
+	
+	def describe(self, calendar):
+		'''Returns the state of the calendar's breaker for the calendar list, or an empty string if it is closed'''
+		with self.lock:
+			breaker = self.breakers.get(calendar)
+			if breaker is None:
+				return ''
+			return breaker['state'] + ' after ' + str(breaker['failures']) + ' failures (' + breaker['reason'] + '). Next attempt ' + datetime.fromtimestamp(breaker['retryAt']).strftime('%Y-%m-%d %H:%M:%S')
+
+# Replaced by init() once the configuration is read
+calendarBreaker = CircuitBreaker(0, 0)
+
+def calendarService(googleCalendar, errors):
+	'''Returns a Google Calendar service for a calendar, or None if it has no valid OAuth token'''
+	import httplib2
+	import oauth2client.file
+	from apiclient import discovery
+	
+	credential_file = googleCalendar + '.json'
+	credential_path = os.path.join(credential_dir, credential_file)
+	store = oauth2client.file.Storage(credential_path)
+	credentials = store.get()
+			
+	if not credentials or credentials.invalid:
+		# Try to refresh credentials
+		try:
+			logger.info ('Attempting to refresh credentials for calendar: %s ', googleCalendar)
+			credentials = credentials.refresh(httplib2.Http())
+		except Exception as e:
+			logger.error ('Exception caught while refreshing credentials: %s', e)
+		if not credentials or credentials.invalid:
+			logger.error ('Google Calendar: %s could not synced. No valid OAuth Token. Have user reauthenticate.', googleCalendar)
+			logger.info ('credential_file: %s credential_path: %s', credential_file, credential_path)
+			logger.info ('credentials: %s ', credentials)
+			errors.append ('Google Calendar: ' + googleCalendar + ' could not synced. No valid OAuth Token. Have user reauthenticate.')
+			return None
+	
+	logger.info('Retrieved valid credentials for calendar: %s', googleCalendar)
 
-						else:
-							logger.info('Deleting event %s from calendar %s. Event no longer in Slate calendar.', eventId, googleCalendar)
-						
-							deleteError = deleteEvent(service, googleApiBackoff, googleCalendar, googleEvents[eventId]['eventId'])
-							
-							calendarModifications.append('Deleting event: ' + googleToDateTime(googleEvents[eventId]['start'], False).strftime("%B %d, %Y %I:%M %p")  + ' - ' +  googleEvents[eventId]['summary'])
-							if (deleteError != ''):
-								errors.append(deleteError)
-					except Exception as e:
-						logger.error ('Error deleting event. Event ID: : %s', eventId)
-						logger.exception(e)
+	http = credentials.authorize(httplib2.Http(timeout=15))
+	
+	try:
+		document = calendarDiscoveryDocument()
+	except Exception as e:
+		logger.warning ('Could not load the Google Calendar discovery document. Exception: %s', e)
+		return discovery.build('calendar', 'v3', http=http, cache_discovery=False)
+	
+	return discovery.build_from_document(document, http=http)
+
+# Parsed Google Calendar API description shared by every calendar's service
+discoveryDocument = None
+discoveryDocumentLock = threading.Lock()
+
+def calendarDiscoveryDocument():
+	'''Returns the Google Calendar API discovery document. It is loaded and parsed once instead of once per calendar.'''
+	global discoveryDocument
+	import httplib2
+	from apiclient import discovery
+	
+	with discoveryDocumentLock:
+		if discoveryDocument is None:
+			# Newer versions of the Google API client ship the document
+			try:
+				from googleapiclient.discovery_cache import get_static_doc
+				content = get_static_doc('calendar', 'v3')
+			except ImportError:
+				content = None
+			
+			if content is None:
+				response, content = httplib2.Http(timeout=15).request(discovery.DISCOVERY_URI.format(api='calendar', apiVersion='v3'))
+				if response.status != 200:
+					raise Exception('HTTP status ' + str(response.status))
+			
+			discoveryDocument = json.loads(content)
+		
+		return discoveryDocument
+
+def readCalendar(googleCalendar, calendarInfo, window, errors, planOnly=False):
+	'''Reads a calendar's events from Google and Slate. Returns None if the calendar could not be read.'''
+	slateCalendar = googleCalendar
+	try:
+		eventColorOnCampus = calendarInfo['eventColorOnCampus']
+	except:
+		eventColorOnCampus = ''
+	try:
+		eventColorOther = calendarInfo['eventColorOther']
+	except:
+		eventColorOther = ''
+
+	# Calendars that keep failing are skipped without any network calls until their next probe is due
+	if not calendarBreaker.allow(googleCalendar):
+		logger.info('Skipping calendar: %s Circuit breaker %s', googleCalendar, calendarBreaker.describe(googleCalendar))
+		return None
+
+	logger.info('Syncing events for calendar: %s', googleCalendar)
+	print('Syncing events for calendar: ', googleCalendar)
+	
+	timings = {}
+	phaseStarted = time.perf_counter()
+
+	credentialErrors = []
+	service = calendarService(googleCalendar, credentialErrors)
+	if service is None:
+		if calendarBreaker.failure(googleCalendar, 'no valid OAuth token'):
+			errors.extend(credentialErrors)
+		return None
+
+	# Register or renew push notification channel
+	if pushNotifications and not planOnly:
+		try:
+			ensureWatchChannel(service, googleCalendar)
+		except Exception as e:
+			logger.error ('Google Calendar: %s Could not register push notification channel. Exception: %s', googleCalendar, e)
+	elif not planOnly and googleCalendar in watchChannels:
+		# Push notifications were turned off. Stop the channel registered while they were on.
+		with watchChannelsLock:
+			channel = watchChannels.pop(googleCalendar)
+			saveWatchChannels()
+		stopWatchChannel(service, googleCalendar, channel)
+	
+	recordPhase(timings, googleCalendar, 'connect', phaseStarted)
+
+	# The far future changes rarely. Only sync the full window every ColdSyncInterval seconds, otherwise sync the hot window.
+	calendarWindowEnd = window['end']
+	coldSync = True
+	if window['hotEnd'] < window['end'] and time.time() - coldWindowSyncTimes.get(googleCalendar, 0) < coldSyncInterval:
+		calendarWindowEnd = window['hotEnd']
+		coldSync = False
+	syncStarted = time.time()
+	logger.info('Google Calendar: %s Syncing events through %s. Full window: %s', googleCalendar, calendarWindowEnd, coldSync)
+	
+	# Get users events
+	duplicates = []
+	phaseStarted = time.perf_counter()
+	googleEvents = readGoogleCalendar(service, googleCalendar, window['begin'], calendarWindowEnd, duplicates)
+	recordPhase(timings, googleCalendar, 'googleRead', phaseStarted)
+	logger.info ('Google Calendar: %s Slate events in Google Calendar: %s', googleCalendar, eventSummary(googleEvents))
+	logger.debug ('Google Calendar: %s Slate events in Google Calendar: %s', googleCalendar, googleEvents)
+	
+	# Get Slate events
+	try:
+		phaseStarted = time.perf_counter()
+		slateEvents = readSlateCalendarWebService(googleCalendar, slateEventWebService, slateEventWebServiceStops, slateEventWebServiceUsername, slateEventWebServicePassword, window['begin'], window['end'])
+		recordPhase(timings, googleCalendar, 'slateRead', phaseStarted)
+	except Exception as e:
+		print ('Unable to retrieve Slate Calendar ', slateCalendar)
+		logger.error ('Google Calendar: %s Unable to retrieve Slate calendar. Exception: %s', googleCalendar, e)
+		calendarBreaker.failure(googleCalendar, 'Slate calendar could not be read')
+		return None
+	
+	if not coldSync:
+		phaseStarted = time.perf_counter()
+		slateEvents = selectHotWindowEvents(service, googleCalendar, slateEvents, googleEvents, window['begin'], calendarWindowEnd)
+		recordPhase(timings, googleCalendar, 'hotWindowLookup', phaseStarted)
+	logger.info ('Google Calendar: %s Slate events in Slate: %s', googleCalendar, eventSummary(slateEvents))
+	logger.debug ('Google Calendar: %s Slate events in Slate: %s', googleCalendar, slateEvents)
+	
+	calendarBreaker.success(googleCalendar)
+	
+	return {
+		'calendar'				: googleCalendar,
+		'service'				: service,
+		'eventColorOnCampus'	: eventColorOnCampus,
+		'eventColorOther'		: eventColorOther,
+		'googleEvents'			: googleEvents,
+		'slateEvents'			: slateEvents,
+		'duplicates'			: duplicates,
+		'fullWindow'			: coldSync,
+		'started'				: syncStarted,
+		'window'				: {
+			'begin'	: window['begin'],
+			'end'	: calendarWindowEnd,
+			'grace'	: window['grace'],
+		},
+		'timings'				: timings,
+	}
+
+def planCalendar(calendarData):
+	'''Compares a calendar's Slate and Google events and returns the changes needed to sync them.
+	
+	The plan only contains plain data so it can be written out with --plan. executePlan() applies it.
+	'''
+	googleCalendar = calendarData['calendar']
+	googleEvents = calendarData['googleEvents']
+	slateEvents = calendarData['slateEvents']
+	
+	diffStarted = time.perf_counter()
+	
+	plan = {
+		'calendar'		: googleCalendar,
+		'fullWindow'	: calendarData['fullWindow'],
+		'started'		: calendarData['started'],
+		'window'		: calendarData['window'],
+		'adds'			: [],
+		'updates'		: [],
+		'deletes'		: [],
+		'graceSkips'	: [],
+		'duplicates'	: calendarData['duplicates'],
+		'timings'		: calendarData['timings'],
+	}
+	
+	googleEventKeys = list(googleEvents.keys())
+	
+	# Compare differences
+	for eventId, eventDetails in slateEvents.items(): # Iterate over Slate Events
+	
+		try:
+			# Determine if event is on campus
+			onCampusEvent = False
+			if (eventDetails['location'].startswith(onCampusInterviewLocation)):
+				onCampusEvent = True
+				
+			#Set eventColor
+			if (onCampusEvent):
+				eventColor = calendarData['eventColorOnCampus']
+			else: 
+				eventColor = calendarData['eventColorOther']
+		
+			if (eventId in googleEvents): #Check if event exists in Google Calendar
+				logger.debug('Event %s from calendar %s already exists in Google Calendar. Look for changes.', eventId, googleCalendar)
+
+				googleEvent = googleEvents[eventId]
+				googleEventKeys.remove(eventId)
+				
+				# Check if event has changed
+				summaryChange = False
+				if (googleEvent['summary'] != eventDetails['summary']):
+					summaryChange = True
+
+				# Check to see if the attendee count changed
+				attendeeChange = False
+				if (summaryChange and eventDetails['type'].lower() == 'event'):
+					googleEventIndex = googleEvent['summary'].rfind('(')
+					slateEventIndex = eventDetails['summary'].rfind('(')
+					if (googleEvent['summary'][0:googleEventIndex] == eventDetails['summary'][0:slateEventIndex]):
+						logger.debug ('Event attendance has changed. Event ID: %s', eventId)
+						attendeeChange = True
 						
-				if (len(calendarModifications) > 0 and emailEventChanges):
+
+				# Check for location change
+				
+				locationChange = False
+				if (googleEvent['location'] != eventDetails['location']):
+					locationChange = True
+				
+				startChange = False
+				if (googleToDateTime(googleEvent['start']) != eventDetails['start']):
+					startChange = True
+				
+				colorChange = False
+				if (googleEvent['colorId'] != eventColor):
+					colorChange = True
+
+				descriptionChange = False
+				if (googleEvent['description'] != eventDetails['description']):
+					descriptionChange = True
+		
+				## Check to see if the end of the event changed. 
+				endChange = False
+				
+				# Slate does not return end date for all day events
+				if ( type(eventDetails['start']) == date and eventDetails['end'] == '' ): 
+					endChange = False
+					
+				# Check to see if the start date is of type datetime but the end date is of type date. If so, make sure event is one hour long
+				elif ( type(eventDetails['start']) == datetime and type(eventDetails['end']) == date and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1))):
+					endChange = False
+				
+				# No end time in Google, make sure end time is 1 hour after start time
+				elif ( eventDetails['end'] == '' and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1)) ):
+					endChange = False
 					
-					msg = MIMEText('\n'.join(calendarModifications))
-					msg['Subject'] = 'Slate Calendar Updates'
-					msg['From'] = emailFrom
-					msg['To'] = googleCalendar
-					s = smtplib.SMTP(mailServer)
-					s.sendmail(emailFrom, googleCalendar, msg.as_string())
-					s.quit()
+				# Check to see if Google has end time by Slate does not
+				elif ( eventDetails['end'] == '' and googleEvent['end'] != ''):
+					endChange = True
 					
-					logger.info('Events have changed in calendar %s. Sending the following email to user: %s', googleCalendar, '***'.join(calendarModifications))
-						
+				# Check to see if the event ends before it starts. If so, make sure end time is 1 hour after start time
+				elif (eventDetails['end'] < eventDetails['start']  and googleToDateTime(googleEvent['end']) == (eventDetails['start'] + timedelta(hours=1)) ):
+					endChange = False
+				
+				elif (googleToDateTime(googleEvent['end']) != eventDetails['end']):
+					endChange = True
+				
+				# Check to see if event changed
+				if (summaryChange or locationChange or startChange or endChange or colorChange or descriptionChange):
+					logger.debug ('Event has changed. summaryChange: %s locationChange: %s descriptionChange: %s startChange: %s endChange: %s colorChange: %s', summaryChange, locationChange, descriptionChange, startChange, endChange, colorChange)
+					logger.debug ('Slate event     %s %s', eventId, eventDetails)
+					
+					logger.debug ('Slate Summary   %s', eventDetails['summary'])
+					logger.debug ('Google Summary  %s', googleEvent['summary'])
+					logger.debug ('Slate location  %s', eventDetails['location'])
+					logger.debug ('Google location %s', googleEvent['location'])
+					logger.debug ('Slate start     %s %s', eventDetails['start'], type(eventDetails['start']))
+					logger.debug ('Google start    %s %s', googleEvent['start'], type(googleEvent['start']))
+					logger.debug ('Slate end       %s %s', eventDetails['end'], type(eventDetails['end']))
+					logger.debug ('Google end      %s %s', googleEvent['end'], type(googleEvent['end']))
+					logger.debug ('Window grace    %s', calendarData['window']['grace'])
+					
+					changes = [field for field, changed in [('summary', summaryChange), ('location', locationChange), ('description', descriptionChange), ('start', startChange), ('end', endChange), ('color', colorChange)] if changed]
+					
+					#Event has changed. Delete old event and recreate.
+					plan['updates'].append({
+						'slateId'		: eventId,
+						'eventId'		: googleEvent['eventId'],
+						'event'			: eventDetails,
+						'color'			: eventColor,
+						'changes'		: changes,
+						# Only send notification if summary or time change
+						'notify'		: (summaryChange and eventDetails['type'].lower() == 'interview') or (summaryChange and not attendeeChange) or startChange,
+						'googleStart'	: googleEvent['start'],
+						'googleSummary'	: googleEvent['summary'],
+					})
+				
+			else:
+				logger.debug('Event %s from calendar %s does not exists in Google Calendar. Add event.', eventId, googleCalendar)
+				
+				plan['adds'].append({
+					'slateId'	: eventId,
+					'event'		: eventDetails,
+					'color'		: eventColor,
+				})
+					
+		except Exception as e:
+				logger.error ('Error processing event. Event ID: : %s', eventId)
+				logger.exception(e)
+		
+	#Remove Google Events that are no longer present in Slate Calendar
+	for eventId in googleEventKeys:
+		try:
+			start = googleToDateTime(googleEvents[eventId]['start'], False)
+			if (isinstance(start, datetime)):
+				start = start.date()
+				
+			if (start < calendarData['window']['grace'].date()):
+				logger.debug('Event %s from calendar %s occurs during grace period. Make no changes to event.', eventId, googleCalendar)
+				plan['graceSkips'].append({
+					'slateId'	: eventId,
+					'eventId'	: googleEvents[eventId]['eventId'],
+					'start'		: googleEvents[eventId]['start'],
+				})
+
+			else:
+				plan['deletes'].append({
+					'slateId'	: eventId,
+					'eventId'	: googleEvents[eventId]['eventId'],
+					'start'		: googleEvents[eventId]['start'],
+					'summary'	: googleEvents[eventId]['summary'],
+				})
+		except Exception as e:
+			logger.error ('Error deleting event. Event ID: : %s', eventId)
+			logger.exception(e)
+	
+	recordPhase(plan['timings'], googleCalendar, 'diff', diffStarted)
+	logger.info ('Google Calendar: %s Planned %s adds, %s updates, %s deletes, %s grace skips, %s duplicates', googleCalendar, len(plan['adds']), len(plan['updates']), len(plan['deletes']), len(plan['graceSkips']), len(plan['duplicates']))
+	
+	return plan
+
+def executePlan(service, plan, errors):
+	'''Makes the changes in a plan from planCalendar() and emails the user about them'''
+	googleCalendar = plan['calendar']
+	executeStarted = time.time()
+	
+	# Store changes
+	calendarModifications = []
+	# Google events added or deleted by this sync
+	changedEventIds = []
+	
+	# Write every change to the journal before making any of them. An update is a delete followed by an add.
+	for update in plan['updates']:
+		update['journalIds'] = [
+			journal.record(googleCalendar, 'delete', update['slateId'], eventId=update['eventId']),
+			journal.record(googleCalendar, 'add', update['slateId'], event=update['event'], color=update['color']),
+		]
+	for add in plan['adds']:
+		add['journalId'] = journal.record(googleCalendar, 'add', add['slateId'], event=add['event'], color=add['color'])
+	for delete in plan['deletes']:
+		delete['journalId'] = journal.record(googleCalendar, 'delete', delete['slateId'], eventId=delete['eventId'])
+	journal.commit()
+	
+	for update in plan['updates']:
+		eventDetails = update['event']
+		try:
+			#Event has changed. Delete old event and recreate.
+			with span(googleCalendar, 'deleteEvent'):
+				deleteError = deleteEvent(service, googleApiBackoff, googleCalendar, update['eventId'])
+			changedEventIds.append(update['eventId'])
+			if (deleteError != ''):
+				errors.append(deleteError)
+			
+			with span(googleCalendar, 'addEvent'):
+				addError = addEvent(service, googleCalendar, update['slateId'], eventDetails['summary'], eventDetails['location'], eventDetails['description'], eventDetails['start'], eventDetails['end'], update['color'], changedEventIds)
+			if (addError != ''):
+				errors.append(addError)
+
+			if (update['notify']):
+				calendarModifications.append('Deleting event: ' + googleToDateTime(update['googleStart'], False).strftime("%B %d, %Y %I:%M %p")  + ' - ' +  update['googleSummary'])
+				calendarModifications.append('Adding event: ' + formatDate(eventDetails['start']) + ' - ' + eventDetails['summary'])
+		except Exception as e:
+			logger.error ('Error processing event. Event ID: : %s', update['slateId'])
+			logger.exception(e)
+		journal.done(*update['journalIds'])
+	
+	for add in plan['adds']:
+		eventDetails = add['event']
+		try:
+			with span(googleCalendar, 'addEvent'):
+				addError = addEvent(service, googleCalendar, add['slateId'], eventDetails['summary'], eventDetails['location'], eventDetails['description'], eventDetails['start'], eventDetails['end'], add['color'], changedEventIds)
+			calendarModifications.append('Adding event: ' + formatDate(eventDetails['start']) + ' - ' + eventDetails['summary'])
+			if (addError != ''):
+				errors.append(addError)
+		except Exception as e:
+			logger.error ('Error processing event. Event ID: : %s', add['slateId'])
+			logger.exception(e)
+		journal.done(add['journalId'])
+	
+	for delete in plan['deletes']:
+		try:
+			logger.info('Deleting event %s from calendar %s. Event no longer in Slate calendar.', delete['slateId'], googleCalendar)
+		
+			with span(googleCalendar, 'deleteEvent'):
+				deleteError = deleteEvent(service, googleApiBackoff, googleCalendar, delete['eventId'])
+			changedEventIds.append(delete['eventId'])
+			
+			calendarModifications.append('Deleting event: ' + googleToDateTime(delete['start'], False).strftime("%B %d, %Y %I:%M %p")  + ' - ' +  delete['summary'])
+			if (deleteError != ''):
+				errors.append(deleteError)
+		except Exception as e:
+			logger.error ('Error deleting event. Event ID: : %s', delete['slateId'])
+			logger.exception(e)
+		journal.done(delete['journalId'])
+	
+	# Google sends push notifications for these changes too. They don't need another sync.
+	ownChanges.record(googleCalendar, changedEventIds)
+	
+	# Duplicates are removed in the background so a calendar full of them doesn't hold up the sync
+	duplicateCompactor.add(googleCalendar, plan['duplicates'], plan['started'])
+			
+	if (len(calendarModifications) > 0 and emailEventChanges):
+		
+		with span(googleCalendar, 'notify'):
+			mailer.notify(googleCalendar, calendarModifications)
+		
+		logger.info('Events have changed in calendar %s. Emailing user %s changes.', googleCalendar, len(calendarModifications))
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('Email to user %s: %s', googleCalendar, '***'.join(calendarModifications))
+	
+	if plan['fullWindow']:
+		coldWindowSyncTimes[googleCalendar] = plan['started']
+	
+	plan['timings']['execute'] = round(time.time() - executeStarted, 3)
+	logger.info ('Google Calendar: %s Sync timings (seconds): %s', googleCalendar, plan['timings'])
+
+def planJsonDefault(o):
+	if isinstance(o, (date, datetime)):
+		return o.isoformat()
+	raise TypeError('Cannot write ' + str(type(o)) + ' to plan')
+
+def writePlan(plans, planFile):
+	import pytz
+	
+	with open(planFile, 'w') as f:
+		json.dump({'created': datetime.now(pytz.utc), 'calendars': plans}, f, indent=4, default=planJsonDefault)
+	
+	logger.info ('Sync plan for %s calendars written to %s', len(plans), planFile)
+	print ('Sync plan for', len(plans), 'calendars written to', planFile)
+
+class MutationJournal:
+	'''Append-only record of the changes executePlan() makes to Google calendars.
+	
+	Changes are written and flushed to disk before any of them are made, and each one is marked done once
+	Google has answered. Changes that were never marked done were interrupted and are finished by
+	replayJournal() when the program starts again. The file is emptied whenever nothing is left to finish.
+	'''
+	
+	def __init__(self, path, enabled=True):
+		self.path = path
+		self.enabled = enabled
+		self.lock = threading.Lock()
+		self.file = None
+		self.unwritten = []
+		self.pending = {}
+	
+	def load(self):
+		'''Returns the changes in the journal that were never marked done, oldest first'''
+		if not self.enabled or not os.path.isfile(self.path):
+			return []
+		
+		with self.lock:
+			with open(self.path, 'r') as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# The last line is cut short if the program stopped while writing it
+						logger.warning ('Journal: Skipping unreadable entry: %s', line.strip())
+						continue
+					
+					if entry['op'] == 'begin':
+						self.pending[entry['id']] = entry
+					else:
+						self.pending.pop(entry['id'], None)
+			
+			return list(self.pending.values())
+	
+	def record(self, calendar, kind, slateId, eventId='', event=None, color=''):
+		'''Adds a change to the journal. Nothing is written to disk until commit(). Returns the change's id.'''
+		if not self.enabled:
+			return None
+		
+		entry = {
+			'op'		: 'begin',
+			'id'		: uuid.uuid4().hex,
+			'calendar'	: calendar,
+			'type'		: kind,
+			'slateId'	: slateId,
+			'eventId'	: eventId,
+			'event'		: event,
+			'color'		: color,
+		}
+		with self.lock:
+			self.unwritten.append(entry)
+		return entry['id']
+	
+	def commit(self):
+		'''Writes recorded changes to disk. One fsync covers every change in a plan.'''
+		with self.lock:
+			if not self.unwritten:
+				return
+			
+			self.write([json.dumps(entry, default=planJsonDefault) for entry in self.unwritten])
+			os.fsync(self.file.fileno())
+			
+			for entry in self.unwritten:
+				self.pending[entry['id']] = entry
+			self.unwritten = []
+	
+	def done(self, *ids):
+		'''Marks changes as finished'''
+		if not self.enabled:
+			return
+		
+		with self.lock:
+			for id in ids:
+				self.pending.pop(id, None)
+			
+			if self.pending:
+				# Not synced to disk. If this is lost the change is replayed, which is safe because replays check Google first.
+				self.write([json.dumps({'op': 'done', 'id': id}) for id in ids])
+			elif self.file is not None or os.path.isfile(self.path):
+				# Nothing left to finish, so the journal can start over
+				self.write([])
+				self.file.seek(0)
+				self.file.truncate()
+				self.file.flush()
+	
+	def write(self, lines):
+		if self.file is None:
+			if not os.path.exists(checkpoint_dir):
+				os.makedirs(checkpoint_dir)
+			self.file = open(self.path, 'a')
+		
+		for line in lines:
+			self.file.write(line + '\n')
+		self.file.flush()
+
+# Replaced by init() once the configuration is read
+journal = MutationJournal(None, False)
+
+def journalDate(value):
+	'''Converts a date written to the journal by planJsonDefault() back to a date or datetime'''
+	if value == '':
+		return value
+	return googleToDateTime(value, False)
+
+def replayJournal():
+	'''Finishes the changes that were interrupted when the program last stopped.
+	
+	Deletes are repeated as is because deleteEvent() treats an event that is already gone as deleted. Adds are only
+	repeated if Google doesn't already have an event for the Slate event. Only calendars with unfinished changes
+	are touched.
+	'''
+	mutations = journal.load()
+	if not mutations:
+		return
+	
+	logger.info ('Journal: Finishing %s interrupted changes', len(mutations))
+	print ('Finishing', len(mutations), 'changes interrupted when the sync last stopped')
+	
+	errors = []
+	calendarMutations = {}
+	for mutation in mutations:
+		calendarMutations.setdefault(mutation['calendar'], []).append(mutation)
+	
+	for googleCalendar, mutations in calendarMutations.items():
+		service = None
+		if googleCalendar in calendars:
+			service = calendarService(googleCalendar, errors)
+		
+		for mutation in mutations:
+			# Changes that can't be finished now are dropped. The next sync of the calendar makes them again.
+			if service is None:
+				logger.warning ('Journal: Google Calendar: %s Dropping interrupted %s of Slate event %s', googleCalendar, mutation['type'], mutation['slateId'])
+				journal.done(mutation['id'])
+				continue
+			
+			try:
+				with span(googleCalendar, 'replay'):
+					if mutation['type'] == 'delete':
+						logger.info ('Journal: Google Calendar: %s Repeating delete of Slate event %s', googleCalendar, mutation['slateId'])
+						error = deleteEvent(service, googleApiBackoff, googleCalendar, mutation['eventId'])
+					elif findGoogleEvent(service, mutation['slateId']) is None:
+						logger.info ('Journal: Google Calendar: %s Repeating add of Slate event %s', googleCalendar, mutation['slateId'])
+						event = mutation['event']
+						error = addEvent(service, googleCalendar, mutation['slateId'], event['summary'], event['location'], event['description'], journalDate(event['start']), journalDate(event['end']), mutation['color'])
+					else:
+						logger.info ('Journal: Google Calendar: %s Slate event %s was already added', googleCalendar, mutation['slateId'])
+						error = ''
+				if error != '':
+					errors.append(error)
+			except Exception as e:
+				logger.error ('Journal: Google Calendar: %s Could not finish %s of Slate event %s', googleCalendar, mutation['type'], mutation['slateId'])
+				logger.exception(e)
+			journal.done(mutation['id'])
 	
-	#Send email if error occured
 	if (len(errors) > 0):
-		msg = MIMEText('\n'.join(errors))
-		msg['Subject'] = 'Slate-Google Sync Errors'
-		msg['From'] = emailFrom
-		msg['To'] =  ', '.join(emailTo)
-		s = smtplib.SMTP(mailServer)
-		s.sendmail(emailFrom, emailTo, msg.as_string())
-		s.quit()
+		mailer.send(emailTo, 'Slate-Google Sync Errors', errors)
+
+def recordSpan(names, elapsed, selfTime=None):
+	'''Writes a timed phase to the trace file. names are appended to the spans open in this thread.'''
+	if not tracing:
+		return
 	
-	#Finish
-	logger.info('Finish SlateSync')
+	stack = getattr(spanStacks, 'stack', [])
+	if stack:
+		stack[-1]['children'] += elapsed
+	
+	if selfTime is None:
+		selfTime = elapsed
+	
+	# One line per span: frames separated by semicolons, then the time spent in this frame in microseconds
+	traceLogger.info('%s %d', ';'.join([frame['name'] for frame in stack] + list(names)), max(0, round(selfTime * 1000000)))
+
+def recordPhase(timings, calendar, phase, started):
+	'''Stores the time since started, from time.perf_counter(), in a calendar's timings and writes the same measurement to the trace'''
+	elapsed = time.perf_counter() - started
+	timings[phase] = round(elapsed, 3)
+	recordSpan((calendar, phase), elapsed)
+
+@contextlib.contextmanager
+def span(*names):
+	'''Times a phase of a sync. Spans opened inside it are nested under it in the trace.'''
+	if not tracing:
+		yield
+		return
+	
+	if not hasattr(spanStacks, 'stack'):
+		spanStacks.stack = []
+	
+	frame = {'name': ';'.join(names), 'started': time.perf_counter(), 'children': 0.0}
+	spanStacks.stack.append(frame)
+	try:
+		yield
+	finally:
+		spanStacks.stack.pop()
+		elapsed = time.perf_counter() - frame['started']
+		recordSpan(names, elapsed, elapsed - frame['children'])
+
+def recordMemory(name):
+	'''Logs the memory allocated by Python now and at its peak since the last call when MemoryTracking is on.
+	Returns the peak in bytes.'''
+	if not memoryTracking:
+		return 0
+	
+	import tracemalloc
+	current, peak = tracemalloc.get_traced_memory()
+	# Python 3.9 and later can measure the peak of each calendar. Before that the peak covers the whole run.
+	if hasattr(tracemalloc, 'reset_peak'):
+		tracemalloc.reset_peak()
+	
+	logger.info ('Memory: %s Current: %s KB Peak: %s KB', name, current // 1024, peak // 1024)
+	return peak
+
+def currentSpan():
+	stack = getattr(spanStacks, 'stack', [])
+	return ';'.join(frame['name'] for frame in stack)
+
+def profileCycle():
+	'''Runs one full sync under cProfile and saves the stats to the traces directory'''
+	import cProfile
+	
+	profiler = cProfile.Profile()
+	profiler.runcall(main)
+	
+	profilePath = os.path.join(trace_dir, 'cycle_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.prof')
+	profiler.dump_stats(profilePath)
+	logger.info ('cProfile stats for sync written to %s', profilePath)
+	print ('cProfile stats for sync written to', profilePath)
 
 def formatDate(d):
+	from pytz import timezone
+	
 	f = ''
 	if (type(d) == date):
 		f = d.strftime("%B %d, %Y")
@@ -433,6 +1285,9 @@ def formatDate(d):
 	return f
 
 def readSlateCalendarWebService (calendar, slateEventWebService, slateEventWebServiceStops, slateEventWebServiceUsername, slateEventWebServicePassword, windowBegin, windowEnd):
+	import requests
+	import pytz
+	
 	logger.info ('readSlateCalendarWebService - Starting method for calendar: %s', calendar)
 
 	events = {}
@@ -544,20 +1399,15 @@ def readSlateCalendarWebService (calendar, slateEventWebService, slateEventWebSe
 					continue
 
 				# Check to see if event is in sync window
-				if (type(tempEvent['start']) == date):
-					startDate = datetime.combine(tempEvent['start'], datetime.min.time(), pytz.utc)
-				else:
-					startDate = tempEvent['start']
-
 				try:
-					if (startDate >= windowBegin and startDate <= windowEnd):
+					if inSyncWindow(tempEvent['start'], windowBegin, windowEnd):
 						# Store event					
 						events[event['GUID']] = tempEvent
 					else:
-						logger.debug('Event %s not in window. startDate: %s windowBegin: %s windowEnd: %s', event['GUID'], startDate, windowBegin, windowEnd)
+						logger.debug('Event %s not in window. start: %s windowBegin: %s windowEnd: %s', event['GUID'], tempEvent['start'], windowBegin, windowEnd)
 				except Exception as e:
 					logger.error ('readSlateCalendar - Error parsing Slate event feed for calendar: : %s', calendar)
-					logger.error ('startDate: %s windowBegin: %s windowEnd: %s', startDate, windowBegin, windowEnd)
+					logger.error ('start: %s windowBegin: %s windowEnd: %s', tempEvent['start'], windowBegin, windowEnd)
 					logger.exception(e)
 
 
@@ -573,8 +1423,56 @@ def readSlateCalendarWebService (calendar, slateEventWebService, slateEventWebSe
 
 	return events
 
+
+def inSyncWindow(start, windowBegin, windowEnd):
+	import pytz
+	
+	# All day events are compared as midnight UTC
+	if (type(start) == date):
+		start = datetime.combine(start, datetime.min.time(), pytz.utc)
+	
+	return start >= windowBegin and start <= windowEnd
+
+def selectHotWindowEvents(service, calendar, slateEvents, googleEvents, windowBegin, windowEnd):
+	'''Narrows Slate events to the hot sync window.
+	
+	Events outside the window are kept if their Google event was listed in the window so that events moved out of
+	the window are updated instead of deleted. Slate events in the window without a listed Google event may have
+	moved in from outside the window. Their Google event is looked up and added to googleEvents.
+	'''
+	hotEvents = {}
+	
+	for eventId, eventDetails in slateEvents.items():
+		if eventId in googleEvents:
+			hotEvents[eventId] = eventDetails
+		
+		elif inSyncWindow(eventDetails['start'], windowBegin, windowEnd):
+			try:
+				googleEvent = findGoogleEvent(service, eventId)
+			except Exception as e:
+				# Adding the event could create a duplicate. Leave it for the next full window sync.
+				logger.error ('Google Calendar: %s Could not look up event. Slate ID: %s Exception: %s', calendar, eventId, e)
+				continue
+			
+			if googleEvent is not None:
+				googleEvents[eventId] = googleEvent
+			hotEvents[eventId] = eventDetails
+	
+	logger.info ('selectHotWindowEvents - %s of %s Slate events for calendar %s are in the hot window', len(hotEvents), len(slateEvents), calendar)
+	
+	return hotEvents
+
+def findGoogleEvent(service, slateId):
+	'''Returns the Google event for a Slate event, or None if there isn't one'''
+	googleRateLimiter.acquire()
+	eventsResult = service.events().list(calendarId='primary', privateExtendedProperty='SlateID=' + slateId, singleEvents=True, maxResults=10).execute()
+	
+	for event in eventsResult.get('items', []):
+		return parseGoogleEvent(event)
+	
+	return None
 	
-def readGoogleCalendar(service, calendar, windowBegin, windowEnd):
+def readGoogleCalendar(service, calendar, windowBegin, windowEnd, duplicates):
 	logger.info ('readGoogleCalendar - Starting method for calendar: %s', calendar)
 	
 	userEvents = {}
@@ -606,47 +1504,16 @@ def readGoogleCalendar(service, calendar, windowBegin, windowEnd):
 						
 						try:
 							if slateID in userEvents:
-								logger.warning ('Google Calendar: %s Duplicate event found in Google Calendar. Deleting... SlateID =  %s', calendar, slateID)
-								deleteEvent(service, googleApiBackoff, calendar, event['id'])
+								# Keep the copy that was created first. The others are removed by the duplicate compactor.
+								googleEvent = parseGoogleEvent(event)
+								if googleEvent['created'] < userEvents[slateID]['created']:
+									googleEvent, userEvents[slateID] = userEvents[slateID], googleEvent
+								logger.debug ('Google Calendar: %s Duplicate event found in Google Calendar. SlateID =  %s', calendar, slateID)
+								duplicates.append({'slateId': slateID, 'eventId': googleEvent['eventId'], 'created': googleEvent['created']})
 						
 							else:
-								description = ''
-								if 'description' in event:
-									description = event['description']
-
 								#Event is a Slate Event. Add it to the dictionary
-								userEvents[slateID] = {
-									'eventId'		: event['id'],
-									'summary'		: event['summary'],
-									'location'		: '',
-									'description'	: description,
-									'start'			: '',
-									'startTimeZone'	: '',
-									'end'			: '',
-									'endTimeZone'	: '',
-									'colorId'		: '',
-								}
-								
-								if 'location' in event:
-									userEvents[slateID]['location'] = event['location']
-								
-								if 'date' in event['start']:
-									userEvents[slateID]['start'] = event['start']['date']
-								elif 'dateTime' in event['start']:
-									userEvents[slateID]['start'] = event['start']['dateTime']
-								if 'date' in event['end']:
-									userEvents[slateID]['end'] = event['end']['date']
-								elif 'dateTime' in event['end']:
-									userEvents[slateID]['end'] = event['end']['dateTime']
-									
-								if 'timeZone' in event['start']:
-									userEvents[slateID]['startTimeZone'] = event['start']['timeZone']
-									
-								if 'timeZone' in event['end']:
-									userEvents[slateID]['endTimeZone'] = event['start']['timeZone']
-									
-								if 'colorId' in event:
-									userEvents[slateID]['colorId'] = event['colorId']
+								userEvents[slateID] = parseGoogleEvent(event)
 							
 						except Exception as e:
 							logger.error ('Could not read Slate event from Google Calendar. Slate ID: : %s', slateID)
@@ -654,11 +1521,57 @@ def readGoogleCalendar(service, calendar, windowBegin, windowEnd):
 	except Exception as e:
 		logger.error ('Could not retrieve events from Google calendar: %s', calendar)
 		logger.exception(e)
+	
+	if duplicates:
+		logger.warning ('Google Calendar: %s Found %s duplicate events', calendar, len(duplicates))
 						
 	return userEvents
+
+def parseGoogleEvent(event):
+	description = ''
+	if 'description' in event:
+		description = event['description']
+
+	googleEvent = {
+		'eventId'		: event['id'],
+		'summary'		: event['summary'],
+		'location'		: '',
+		'description'	: description,
+		'start'			: '',
+		'startTimeZone'	: '',
+		'end'			: '',
+		'endTimeZone'	: '',
+		'colorId'		: '',
+		'created'		: event.get('created', ''),
+	}
+	
+	if 'location' in event:
+		googleEvent['location'] = event['location']
+	
+	if 'date' in event['start']:
+		googleEvent['start'] = event['start']['date']
+	elif 'dateTime' in event['start']:
+		googleEvent['start'] = event['start']['dateTime']
+	if 'date' in event['end']:
+		googleEvent['end'] = event['end']['date']
+	elif 'dateTime' in event['end']:
+		googleEvent['end'] = event['end']['dateTime']
+		
+	if 'timeZone' in event['start']:
+		googleEvent['startTimeZone'] = event['start']['timeZone']
+		
+	if 'timeZone' in event['end']:
+		googleEvent['endTimeZone'] = event['start']['timeZone']
+		
+	if 'colorId' in event:
+		googleEvent['colorId'] = event['colorId']
+	
+	return googleEvent
 		
 
-def addEvent(service, calendar, slateId, summary, location, description, start, end, eventColor):
+def addEvent(service, calendar, slateId, summary, location, description, start, end, eventColor, added=None):
+	'''Creates a Google event for a Slate event. Returns an error message, or an empty string if the event was created.
+	If added is a list, the id of the new Google event is added to it.'''
 	logger.debug('addEvent method. Calendar = [%s] slateId = [%s] summary = [%s] description = [%s] location = [%s] start = [%s] end = [%s]', calendar, slateId, summary, description, location, start, end)
 
 	addError = ''
@@ -721,8 +1634,12 @@ def addEvent(service, calendar, slateId, summary, location, description, start,
 		event['colorId'] = eventColor
 	
 	try:
-		service.events().insert(calendarId='primary', body=event).execute()
-		logger.info ('Google Calendar: %s Event created: %s', calendar, event)
+		googleRateLimiter.acquire()
+		response = service.events().insert(calendarId='primary', body=event).execute()
+		if added is not None:
+			added.append(response['id'])
+		logger.info ('Google Calendar: %s Event created. Slate ID: %s Start: %s', calendar, slateId, startIso)
+		logger.debug ('Google Calendar: %s Event created: %s', calendar, event)
 	except Exception as e:
 		logger.error ('Google Calendar: %s Could not create event: %s Exception: %s', calendar, event, e)
 		addError = 'Google Calendar: ' + str(calendar) + ' Could not create event: '  + str(event) + 'Exception:' + str(e)
@@ -730,15 +1647,26 @@ def addEvent(service, calendar, slateId, summary, location, description, start,
 	return addError
 	
 	
-def deleteEvent(service, googleApiBackoff, calendar, eventId):
+def deleteEvent(service, googleApiBackoff, calendar, eventId, rateLimited=None):
+	'''Deletes a Google event. Returns an error message, or an empty string if the event is gone.
+	If rateLimited is a list, the event id is added to it when Google refuses the delete with 403 or 429 so the caller can retry it.'''
+	from googleapiclient.errors import HttpError
+	
 	deleteError = ''
 	try:
+		googleRateLimiter.acquire()
 		service.events().delete(calendarId='primary', eventId=eventId).execute()
 		logger.info ('Google Calendar: %s Event deleted. Event Id: %s', calendar, eventId)
 	except HttpError as e:
-		if e.resp.status in [403]:
-			logger.info('Google Calendar: %s Could not delete event: %s 403 error received. Backing off for %s seconds', calendar, eventId, googleApiBackoff)
+		if e.resp.status in [404, 410]:
+			logger.info ('Google Calendar: %s Event already deleted. Event Id: %s', calendar, eventId)
+			return deleteError
+		
+		if e.resp.status in [403, 429]:
+			logger.info('Google Calendar: %s Could not delete event: %s %s error received. Backing off for %s seconds', calendar, eventId, e.resp.status, googleApiBackoff)
 			time.sleep(int(googleApiBackoff))
+			if rateLimited is not None:
+				rateLimited.append(eventId)
 
 		logger.error ('Google Calendar: %s Could not delete event: %s Exception: %s', calendar, eventId, e)
 		deleteError = 'Google Calendar: ' + str(calendar) + ' Could not delete event: '  + str(eventId) + 'Exception:' + str(e)
@@ -748,7 +1676,275 @@ def deleteEvent(service, googleApiBackoff, calendar, eventId):
 		deleteError = 'Google Calendar: ' + str(calendar) + ' Could not delete event: '  + str(eventId) + 'Exception:' + str(e)
 		
 	return deleteError
+
+class RateLimiter:
+	'''Spaces out Google API requests from all threads to at most rate requests per second. A rate of 0 means no limit.'''
+	
+	def __init__(self, rate):
+		self.rate = rate
+		self.lock = threading.Lock()
+		self.nextRequest = 0
+	
+	def acquire(self):
+		if self.rate <= 0:
+			return
+		
+		with self.lock:
+			now = time.monotonic()
+			wait = self.nextRequest - now
+			self.nextRequest = max(now, self.nextRequest) + 1.0 / self.rate
+		
+		if wait > 0:
+			time.sleep(wait)
+
+# Replaced by init() once the configuration is read
+googleRateLimiter = RateLimiter(0)
+
+def clearCalendar(calendar):
+	'''Deletes every Slate event from a Google calendar.
 	
+	Slate events are listed page by page, then deleted in batches by ClearWorkers threads. The events that are
+	left are saved to a checkpoint file after every batch so an interrupted clear picks up where it stopped.
+	The calendar is listed again at the end and the clear repeats until no Slate events are left. Events Google
+	refused because of rate limits are retried with backoff. The clear stops when only other failures are left.
+	'''
+	import httplib2
+	from apiclient import discovery
+	
+	credentials = getGoogleCredentials(calendar, credential_dir)
+	service = discovery.build('calendar', 'v3', http=credentials.authorize(httplib2.Http()), cache_discovery=False)
+	
+	# Service objects are not thread safe. Each worker builds its own.
+	workerData = threading.local()
+	def deleteWorker(eventId):
+		if not hasattr(workerData, 'service'):
+			workerData.service = discovery.build('calendar', 'v3', http=credentials.authorize(httplib2.Http(timeout=15)), cache_discovery=False)
+		return deleteEvent(workerData.service, googleApiBackoff, calendar, eventId, rateLimited)
+	
+	if not os.path.exists(checkpoint_dir):
+		os.makedirs(checkpoint_dir)
+	checkpointPath = os.path.join(checkpoint_dir, calendar + '.clear.json')
+	
+	def saveCheckpoint():
+		# Write the checkpoint atomically so an interruption never leaves a partial file
+		with open(checkpointPath + '.tmp', 'w') as f:
+			json.dump(checkpoint, f)
+		os.replace(checkpointPath + '.tmp', checkpointPath)
+	
+	if os.path.isfile(checkpointPath):
+		with open(checkpointPath, 'r') as f:
+			checkpoint = json.load(f)
+		
+		# A checkpoint with no events left was saved between the last batch and listing the calendar again
+		if not checkpoint['eventIds']:
+			checkpoint['eventIds'] = listSlateEventIds(service, calendar)
+		
+		logger.info ('Resuming clear of calendar %s. %s events left to delete.', calendar, len(checkpoint['eventIds']))
+		print ('Resuming clear of calendar', calendar, '-', len(checkpoint['eventIds']), 'events left to delete')
+	else:
+		checkpoint = {'eventIds': listSlateEventIds(service, calendar), 'deleted': 0, 'failed': 0}
+		saveCheckpoint()
+	
+	started = time.time()
+	deletedThisRun = 0
+	
+	# Passes in a row that can end with only rate limited events left before the clear gives up
+	rateLimitRetries = 5
+	retries = 0
+	
+	with concurrent.futures.ThreadPoolExecutor(max_workers=clearWorkers) as executor:
+		while checkpoint['eventIds']:
+			failedIds = []
+			rateLimited = []
+			deletedBeforePass = checkpoint['deleted']
+			
+			while checkpoint['eventIds']:
+				batch = checkpoint['eventIds'][:clearBatchSize]
+				
+				for eventId, deleteError in zip(batch, executor.map(deleteWorker, batch)):
+					if deleteError == '':
+						checkpoint['deleted'] += 1
+						deletedThisRun += 1
+					else:
+						checkpoint['failed'] += 1
+						failedIds.append(eventId)
+				
+				checkpoint['eventIds'] = checkpoint['eventIds'][len(batch):]
+				saveCheckpoint()
+				
+				elapsed = time.time() - started
+				print ('Deleted', checkpoint['deleted'], 'events.', len(checkpoint['eventIds']), 'left.', checkpoint['failed'], 'failed.', round(deletedThisRun / max(elapsed, 0.001), 1), 'events/second')
+			
+			# Catch events that failed or were added while clearing. Save them so running the clear again retries them.
+			checkpoint['eventIds'] = listSlateEventIds(service, calendar)
+			saveCheckpoint()
+			
+			# Only give up on rate limits once passes stop making progress
+			if checkpoint['deleted'] > deletedBeforePass:
+				retries = 0
+			
+			eventsLeft = set(checkpoint['eventIds'])
+			if eventsLeft and eventsLeft <= set(failedIds):
+				if eventsLeft & set(rateLimited) and retries < rateLimitRetries:
+					retries += 1
+					backoff = int(googleApiBackoff) * 2 ** retries
+					logger.info ('Clear of calendar %s rate limited. Retrying %s events in %s seconds.', calendar, len(eventsLeft), backoff)
+					print ('Rate limited by Google. Retrying', len(eventsLeft), 'events in', backoff, 'seconds')
+					time.sleep(backoff)
+					continue
+				
+				logger.error ('Clear of calendar %s stopped. %s events could not be deleted.', calendar, len(eventsLeft))
+				print ('Clear stopped.', len(eventsLeft), 'events could not be deleted. Run the clear again to retry.')
+				return False
+	
+	os.remove(checkpointPath)
+	
+	elapsed = time.time() - started
+	logger.info ('Calendar %s cleared. Deleted %s events in %s seconds (%s events/second).', calendar, checkpoint['deleted'], round(elapsed, 1), round(deletedThisRun / max(elapsed, 0.001), 1))
+	return True
+
+def listSlateEventIds(service, calendar):
+	'''Returns the Google event ids of every Slate event in a calendar'''
+	eventIds = []
+	pageToken = None
+	
+	while True:
+		googleRateLimiter.acquire()
+		eventsResult = service.events().list(calendarId='primary', pageToken=pageToken, maxResults=2500, showDeleted=False,
+			fields='nextPageToken,items(id,extendedProperties/private/SlateID)').execute()
+		
+		for event in eventsResult.get('items', []):
+			if 'SlateID' in event.get('extendedProperties', {}).get('private', {}):
+				eventIds.append(event['id'])
+		
+		print ('Listed', len(eventIds), 'Slate events in calendar', calendar)
+		
+		pageToken = eventsResult.get('nextPageToken')
+		if not pageToken:
+			break
+	
+	logger.info ('Google Calendar: %s Found %s Slate events', calendar, len(eventIds))
+	return eventIds
+	
+class DuplicateCompactor:
+	'''Deletes duplicate Google events from a background thread.
+	
+	Each sync hands over the duplicates it found in a calendar. They are merged by event id with the ones still
+	waiting, skipping events that are being deleted or were deleted after the sync read the calendar, so a hot
+	window sync never drops duplicates found further out and no event is deleted twice. They are deleted batchSize
+	at a time with a pause of batchInterval seconds between batches, on top of GoogleApiRateLimit, so a calendar
+	with hundreds of duplicates never holds up syncing.
+	'''
+	
+	def __init__(self, batchSize=50, batchInterval=1):
+		self.batchSize = batchSize
+		self.batchInterval = batchInterval
+		self.condition = threading.Condition()
+		# Calendar -> {event id: duplicate} waiting to be deleted
+		self.pending = {}
+		# Calendar -> event ids in the batch being deleted
+		self.inFlight = {}
+		# Calendar -> {event id: time deleted}. Kept until a sync that read the calendar after the delete hands over its duplicates.
+		self.deleted = {}
+		# Calendar -> {'found': duplicates found by the last sync, 'removed': duplicates deleted since the program started}
+		self.counts = {}
+		self.thread = None
+	
+	def add(self, calendar, duplicates, readStarted=0):
+		'''Queues duplicates found by a sync that started reading the calendar at readStarted'''
+		with self.condition:
+			counts = self.counts.setdefault(calendar, {'found': 0, 'removed': 0})
+			counts['found'] = len(duplicates)
+			
+			# Deletes made before this read started can't show up in it, or in any later read
+			deleted = self.deleted.get(calendar, {})
+			for eventId in [eventId for eventId, deletedAt in deleted.items() if deletedAt < readStarted]:
+				del deleted[eventId]
+			
+			pending = self.pending.setdefault(calendar, {})
+			inFlight = self.inFlight.get(calendar, set())
+			for duplicate in duplicates:
+				if duplicate['eventId'] not in inFlight and duplicate['eventId'] not in deleted:
+					pending.setdefault(duplicate['eventId'], duplicate)
+			
+			if pending:
+				self.start()
+				self.condition.notify()
+			else:
+				del self.pending[calendar]
+	
+	def describe(self, calendar):
+		'''Returns the calendar's duplicate counts for the calendar list, or an empty string if it has none'''
+		with self.condition:
+			counts = self.counts.get(calendar)
+			if counts is None or (counts['found'] == 0 and counts['removed'] == 0):
+				return ''
+			return str(counts['found']) + ' duplicate events found by the last sync, ' + str(len(self.pending.get(calendar, []))) + ' waiting to be deleted, ' + str(counts['removed']) + ' deleted'
+	
+	def start(self):
+		# Caller must hold self.condition
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name='DuplicateCompactor')
+			self.thread.daemon = True
+			self.thread.start()
+	
+	def run(self):
+		services = {}
+		
+		while True:
+			with self.condition:
+				while not self.pending:
+					# Services are only kept while there is work so credentials are read again next time
+					services = {}
+					self.condition.wait()
+				
+				calendar = next(iter(self.pending))
+				pending = self.pending[calendar]
+				batch = [pending.pop(eventId) for eventId in list(pending)[:self.batchSize]]
+				if not pending:
+					del self.pending[calendar]
+				self.inFlight[calendar] = set(duplicate['eventId'] for duplicate in batch)
+			
+			try:
+				self.compact(calendar, batch, services)
+			except Exception as e:
+				logger.error ('Duplicate compactor: Google Calendar: %s Unhandled exception while deleting duplicates.', calendar)
+				logger.exception(e)
+			finally:
+				with self.condition:
+					del self.inFlight[calendar]
+			
+			time.sleep(self.batchInterval)
+	
+	def compact(self, calendar, batch, services):
+		if calendar not in services:
+			# Service objects are not thread safe, so this thread builds its own
+			services[calendar] = calendarService(calendar, [])
+		service = services[calendar]
+		if service is None:
+			return
+		
+		removed = []
+		with span(calendar, 'compactDuplicates'):
+			for duplicate in batch:
+				logger.info ('Duplicate compactor: Google Calendar: %s Deleting duplicate event. SlateID =  %s', calendar, duplicate['slateId'])
+				if deleteEvent(service, googleApiBackoff, calendar, duplicate['eventId']) == '':
+					removed.append(duplicate['eventId'])
+		
+		ownChanges.record(calendar, removed)
+		
+		with self.condition:
+			self.counts.setdefault(calendar, {'found': 0, 'removed': 0})['removed'] += len(removed)
+			deleted = self.deleted.setdefault(calendar, {})
+			for eventId in removed:
+				deleted[eventId] = time.time()
+			remaining = len(self.pending.get(calendar, {}))
+		
+		logger.info ('Duplicate compactor: Google Calendar: %s Deleted %s of %s duplicate events. %s waiting.', calendar, len(removed), len(batch), remaining)
+
+# Replaced by init() once the configuration is read
+duplicateCompactor = DuplicateCompactor()
+
 def getGoogleCredentials(email_address, credential_dir):
 	"""Gets valid user credentials from storage.
 
@@ -758,6 +1954,9 @@ def getGoogleCredentials(email_address, credential_dir):
 	Returns:
 		Credentials, the obtained credential.
 	"""
+	import oauth2client.file
+	from oauth2client import client
+	from oauth2client import tools
 	
 	credential_file = email_address + '.json'
 	credential_path = os.path.join(credential_dir, credential_file)
@@ -772,6 +1971,8 @@ def getGoogleCredentials(email_address, credential_dir):
 	return credentials
 
 def googleToDateTime(date1, convertToUTC=True):	
+	from pytz import timezone
+	
 	if (len(date1) == 10): # Check if date is YYYY-MM-DD format
 		try:
 			year = date1[0:4]
@@ -827,15 +2028,422 @@ def deleteCalendar(delete_calendar):
 			
 			
 			
+# Email
+class Mailer:
+	'''Sends email from a background thread so syncing never waits on the mail server.
+	
+	All messages waiting when the thread wakes up are sent over a single SMTP connection. If the mail server
+	cannot be reached the whole batch is retried with exponential backoff. A message the server keeps failing
+	is retried on its own and then dropped, so it doesn't hold up the rest of the batch. When digestPeriod is set, event change
+	notifications for a user are collected and sent as one email per period.
+	'''
+
+	def __init__(self, server, digestPeriod=0, retries=5, backoff=30):
+		self.server = server
+		self.digestPeriod = digestPeriod
+		self.retries = retries
+		self.backoff = backoff
+		self.condition = threading.Condition()
+		self.outbox = []
+		# User -> {'lines': notification lines, 'due': time the digest is sent}
+		self.digests = {}
+		self.thread = None
+
+	def send(self, to, subject, lines):
+		'''Queues an email. to can be a single address or a list of addresses.'''
+		from email.mime.text import MIMEText
+		
+		msg = MIMEText('\n'.join(lines))
+		msg['Subject'] = subject
+		msg['From'] = emailFrom
+		if isinstance(to, list):
+			msg['To'] = ', '.join(to)
+		else:
+			msg['To'] = to
+		
+		with self.condition:
+			self.outbox.append((to, msg))
+			self.start()
+			self.condition.notify()
+
+	def notify(self, user, lines):
+		'''Queues event change notifications for a user'''
+		if self.digestPeriod <= 0:
+			self.send(user, 'Slate Calendar Updates', lines)
+			return
+		
+		with self.condition:
+			if user not in self.digests:
+				self.digests[user] = {'lines': [], 'due': time.time() + self.digestPeriod}
+			self.digests[user]['lines'].extend(lines)
+			self.start()
+			self.condition.notify()
+
+	def start(self):
+		# Caller must hold self.condition
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name='Mailer')
+			self.thread.daemon = True
+			self.thread.start()
+
+	def run(self):
+		from email.mime.text import MIMEText
+		
+		while True:
+			with self.condition:
+				while True:
+					now = time.time()
+					for user in [user for user, digest in self.digests.items() if digest['due'] <= now]:
+						digest = self.digests.pop(user)
+						msg = MIMEText('\n'.join(digest['lines']))
+						msg['Subject'] = 'Slate Calendar Updates'
+						msg['From'] = emailFrom
+						msg['To'] = user
+						self.outbox.append((user, msg))
+					
+					if self.outbox:
+						break
+					
+					if self.digests:
+						self.condition.wait(min(digest['due'] for digest in self.digests.values()) - now)
+					else:
+						self.condition.wait()
+				
+				messages = self.outbox
+				self.outbox = []
+			
+			try:
+				with span('mailer', 'smtp'):
+					self.deliver(messages)
+			except Exception as e:
+				# Keep the thread alive, otherwise every later email waits in the outbox forever
+				logger.error ('Mailer: Unhandled exception while sending email. Discarding %s emails.', len(messages))
+				logger.exception(e)
+
+	def deliver(self, messages):
+		import smtplib
+		
+		attempt = 0
+		# Number of times the first message in messages has failed
+		failures = 0
+		while messages:
+			delay = 0
+			try:
+				s = smtplib.SMTP(self.server, timeout=60)
+				try:
+					while messages:
+						to, msg = messages[0]
+						try:
+							s.sendmail(emailFrom, to, msg.as_string())
+							logger.debug ('Mailer: Sent email to %s. Subject: %s', to, msg['Subject'])
+						except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+							# Retrying will not help this message
+							logger.error ('Mailer: Could not send email to %s. Subject: %s Exception: %s', to, msg['Subject'], e)
+						except smtplib.SMTPServerDisconnected:
+							raise
+						except smtplib.SMTPException as e:
+							# Only this message failed. Retry it, but drop it rather than the whole batch if it keeps failing.
+							failures += 1
+							if failures <= self.retries:
+								delay = self.backoff * 2 ** (failures - 1)
+								logger.warning ('Mailer: Could not send email to %s. Subject: %s Retrying in %s seconds. Exception: %s', to, msg['Subject'], delay, e)
+								break
+							logger.error ('Mailer: Could not send email to %s after %s attempts. Subject: %s Exception: %s', to, failures, msg['Subject'], e)
+						except OSError:
+							raise
+						except Exception as e:
+							# For example an address that can't be encoded. Retrying will not help this message.
+							logger.error ('Mailer: Could not send email to %s. Subject: %s Exception: %s', to, msg['Subject'], e)
+						messages.pop(0)
+						failures = 0
+				finally:
+					try:
+						s.quit()
+					except smtplib.SMTPException:
+						s.close()
+				
+				if delay:
+					time.sleep(delay)
+			
+			except (smtplib.SMTPException, OSError) as e:
+				attempt += 1
+				if attempt > self.retries:
+					logger.error ('Mailer: Could not connect to mail server %s. Discarding %s emails. Exception: %s', self.server, len(messages), e)
+					return
+				
+				delay = self.backoff * 2 ** (attempt - 1)
+				logger.warning ('Mailer: Could not connect to mail server %s. Retrying %s emails in %s seconds. Exception: %s', self.server, len(messages), delay, e)
+				time.sleep(delay)
+
+# Created by init() once the configuration is read
+mailer = None
+
+
+# Push Notifications
+def ensureWatchChannel(service, calendar):
+	'''Registers a Google push notification channel for a calendar. Channels are renewed before they expire.'''
+	channel = watchChannels.get(calendar)
+
+	# Renew early enough that a safety-net sync will always run before the channel expires
+	renewBefore = time.time() + max(2 * safetySyncInterval, 3600)
+	if channel is not None and channel['expiration'] > renewBefore:
+		return
+
+	body = {
+		'id'		: str(uuid.uuid4()),
+		'type'		: 'web_hook',
+		'address'	: urllib.parse.urljoin(syncServerUrl, 'notifications'),
+		'token'		: secrets.token_urlsafe(24),
+		'params'	: {
+			'ttl'	: str(watchChannelTtl),
+		},
+	}
+
+	response = service.events().watch(calendarId='primary', body=body).execute()
+
+	# Expiration is returned in milliseconds
+	expiration = int(response.get('expiration', 0)) / 1000
+	if expiration == 0:
+		expiration = time.time() + watchChannelTtl
+
+	# Notifications are checked against the changes listed since this sync token. A renewed channel keeps its token.
+	syncToken = None
+	if channel is not None:
+		syncToken = channel.get('syncToken')
+	if syncToken is None:
+		try:
+			syncToken = listChangedEvents(service, None)[1]
+		except Exception as e:
+			logger.warning ('Google Calendar: %s Could not get a sync token. Exception: %s', calendar, e)
+
+	with watchChannelsLock:
+		watchChannels[calendar] = {
+			'id'			: response['id'],
+			'resourceId'	: response['resourceId'],
+			'token'			: body['token'],
+			'expiration'	: expiration,
+			'syncToken'		: syncToken,
+		}
+		saveWatchChannels()
+	logger.info ('Google Calendar: %s Registered push notification channel %s. Expires: %s', calendar, response['id'], datetime.fromtimestamp(expiration))
+
+	# Stop the channel that was renewed
+	if channel is not None:
+		stopWatchChannel(service, calendar, channel)
+
+def stopWatchChannel(service, calendar, channel):
+	try:
+		service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resourceId']}).execute()
+		logger.info ('Google Calendar: %s Stopped push notification channel %s', calendar, channel['id'])
+	except Exception as e:
+		logger.warning ('Google Calendar: %s Could not stop push notification channel %s. Exception: %s', calendar, channel['id'], e)
+
+def findWatchChannelCalendar(channelId, token):
+	'''Returns the calendar a push notification channel belongs to, or None if the channel is unknown'''
+	with watchChannelsLock:
+		for calendar, channel in watchChannels.items():
+			if channel['id'] == channelId and secrets.compare_digest(channel['token'].encode('utf8'), token.encode('utf8')):
+				return calendar
+	return None
+
+def listChangedEvents(service, syncToken):
+	'''Lists the events changed since syncToken was issued. With no syncToken only a token for future changes is fetched.
+	Returns the changed events and the next sync token.'''
+	changed = []
+	pageToken = None
+	while True:
+		googleRateLimiter.acquire()
+		if syncToken is None:
+			result = service.events().list(calendarId='primary', maxResults=2500, pageToken=pageToken, fields='nextPageToken,nextSyncToken').execute()
+		else:
+			result = service.events().list(calendarId='primary', maxResults=2500, pageToken=pageToken, syncToken=syncToken).execute()
+			changed.extend(result.get('items', []))
+		
+		pageToken = result.get('nextPageToken')
+		if pageToken is None:
+			return changed, result.get('nextSyncToken')
+
+def slateEventsChanged(calendar):
+	'''Checks whether a push notification needs a sync. Lists the calendar's events changed since the last check.
+	Returns False if every change was made by this program or was to an event that isn't a Slate event. If the
+	changes can't be listed the calendar is synced to be safe.'''
+	from googleapiclient.errors import HttpError
+	
+	with watchChannelsLock:
+		syncToken = watchChannels.get(calendar, {}).get('syncToken')
+	
+	try:
+		service = calendarService(calendar, [])
+		if service is None:
+			return True
+		
+		try:
+			changed, nextSyncToken = listChangedEvents(service, syncToken)
+		except HttpError as e:
+			if e.resp.status != 410:
+				raise
+			# The token expired. Start again with a new one.
+			logger.info ('Google Calendar: %s Sync token expired', calendar)
+			syncToken = None
+			changed, nextSyncToken = listChangedEvents(service, None)
+	except Exception as e:
+		logger.error ('Google Calendar: %s Could not list changed events. Exception: %s', calendar, e)
+		return True
+	
+	with watchChannelsLock:
+		if calendar in watchChannels:
+			watchChannels[calendar]['syncToken'] = nextSyncToken
+			saveWatchChannels()
+	
+	if syncToken is None:
+		# Nothing to compare against
+		return True
+	
+	# Deleted events may only have an id, so they can't be told apart from other events
+	slateChanges = [event for event in changed if event.get('status') == 'cancelled' or 'SlateID' in event.get('extendedProperties', {}).get('private', {})]
+	otherChanges = [event['id'] for event in slateChanges if not ownChanges.isOwn(calendar, event)]
+	logger.info ('Google Calendar: %s %s events changed, %s Slate events changed by others', calendar, len(changed), len(otherChanges))
+	logger.debug ('Google Calendar: %s Slate events changed by others: %s', calendar, otherChanges)
+	
+	return len(otherChanges) > 0
+
+class OwnChanges:
+	'''Google events this program added or deleted recently, by calendar. Google sends push notifications for these
+	changes too. They are ignored when deciding whether a notification needs a sync.'''
+
+	# Seconds Google's clock may be ahead of this server's
+	CLOCK_SKEW = 5
+
+	def __init__(self, keep=86400):
+		self.keep = keep
+		self.lock = threading.Lock()
+		# Calendar -> {eventId: time of the change}
+		self.changes = {}
+
+	def record(self, calendar, eventIds):
+		if not pushNotifications:
+			return
+		
+		now = time.time()
+		with self.lock:
+			changes = self.changes.setdefault(calendar, {})
+			for eventId in eventIds:
+				changes[eventId] = now
+			# Notifications for older changes have long been handled
+			for eventId in [eventId for eventId, changed in changes.items() if changed < now - self.keep]:
+				del changes[eventId]
+
+	def isOwn(self, calendar, event):
+		'''Returns True if the last change to an event listed by Google was made by this program'''
+		with self.lock:
+			changed = self.changes.get(calendar, {}).get(event['id'])
+		if changed is None:
+			return False
+		if 'updated' not in event:
+			return True
+		
+		# Updated is in UTC, for example 2021-09-21T14:03:55.123Z
+		updated = (datetime.strptime(event['updated'][:19], '%Y-%m-%dT%H:%M:%S') - datetime(1970, 1, 1)).total_seconds()
+		return updated <= changed + self.CLOCK_SKEW
+
+ownChanges = OwnChanges()
+
+class SyncRequestQueue:
+	'''Calendars waiting for a targeted sync. Requests for a calendar that is already queued are merged into a single sync.'''
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		# Calendar -> time the sync is due
+		self.pending = {}
+		# Calendars queued only by push notifications. They are checked for changes before they are synced.
+		self.notified = set()
+
+	def put(self, calendar, delay=0, notification=False):
+		'''Queues a calendar to be synced after delay seconds. Returns False if the request was merged into one already queued.'''
+		with self.condition:
+			if not notification:
+				self.notified.discard(calendar)
+			elif calendar not in self.pending:
+				self.notified.add(calendar)
+			
+			due = time.time() + delay
+			if calendar in self.pending and self.pending[calendar] <= due:
+				return False
+			self.pending[calendar] = due
+			self.condition.notify()
+			return True
+
+	def get(self, timeout):
+		'''Waits up to timeout seconds for queued calendars to become due. Returns a list of (calendar, notified) for the
+		due calendars, which may be empty. notified is True if the calendar was only queued by push notifications.'''
+		deadline = time.time() + timeout
+		with self.condition:
+			while True:
+				now = time.time()
+				due = [calendar for calendar, dueTime in self.pending.items() if dueTime <= now]
+				if due:
+					for calendar in due:
+						del self.pending[calendar]
+					notified = self.notified.intersection(due)
+					self.notified.difference_update(due)
+					return [(calendar, calendar in notified) for calendar in due]
+				if now >= deadline:
+					return []
+				self.condition.wait(min([deadline] + list(self.pending.values())) - now)
+
+# Push notification channels by calendar. Saved to watch_channel_file so channels are reused after a restart
+# instead of being registered again while the old ones keep sending notifications.
+watchChannels = {}
+watchChannelsLock = threading.Lock()
+
+def loadWatchChannels():
+	'''Loads the push notification channels saved by a previous run. Expired channels and channels of calendars
+	that are no longer synced are dropped.'''
+	global watchChannels
+	
+	if not os.path.isfile(watch_channel_file):
+		return
+	
+	try:
+		with open(watch_channel_file, 'r') as f:
+			saved = json.load(f)
+	except ValueError as e:
+		logger.error ('Could not read push notification channels from %s. Exception: %s', watch_channel_file, e)
+		return
+	
+	with watchChannelsLock:
+		watchChannels = {calendar: channel for calendar, channel in saved.items() if calendar in calendars and channel['expiration'] > time.time()}
+	logger.info ('Loaded %s push notification channels', len(watchChannels))
+
+def saveWatchChannels():
+	# Caller must hold watchChannelsLock. The file holds channel tokens, so only the owner can read it.
+	if not os.path.exists(checkpoint_dir):
+		os.makedirs(checkpoint_dir)
+	
+	fd = os.open(watch_channel_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	with os.fdopen(fd, 'w') as f:
+		json.dump(watchChannels, f, indent=4, sort_keys=True)
+	os.replace(watch_channel_file + '.tmp', watch_channel_file)
+
+# Calendars queued for a targeted sync
+syncRequests = SyncRequestQueue()
+
+
 # HTTP Server
 class testHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 
 	# GET
 	def do_GET(self):
+		import httplib2
+		import oauth2client.file
+		from oauth2client import client
+		from apiclient import discovery
+		
 		print(self.path)
 		parsed = urlparse(self.path)
 		parameters = (urllib.parse.parse_qs(parsed.query))
 		message = ''
+		status = 200
 				
 		if self.path.startswith('/sync'):
 			# Initial page entered by user		
@@ -852,11 +2460,21 @@ class testHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 
 		elif self.path.startswith('/?error='):
 			message = 'Error occured while requesting authorization from Google.'
+		
+		elif self.path.startswith('/trigger'):
+			status, message = self.triggerSync(parameters)
 			
 		elif 'calendarlist' in self.path:
 			message = ''
 			for googleCalendar in sorted(calendars):
-				message += googleCalendar + '<br />'
+				message += googleCalendar
+				breakerState = calendarBreaker.describe(googleCalendar)
+				if breakerState != '':
+					message += ' - Sync paused: ' + html.escape(breakerState)
+				duplicateState = duplicateCompactor.describe(googleCalendar)
+				if duplicateState != '':
+					message += ' - ' + duplicateState
+				message += '<br />'
 			
 		elif 'code' in self.path:
 			# Page redirected back from auth server
@@ -889,7 +2507,31 @@ class testHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 					message = 'Successfully added calendar ' + new_calendar
 				
 				else:
-					message = 'Calendar already exists: ' + new_calendar
+					# The user is re-authenticating. Replace the credentials and sync again straight away.
+					with lock:
+						credential_file = new_calendar + '.json'
+						credential_path = os.path.join(credential_dir, credential_file)
+						storage = oauth2client.file.Storage(credential_path)
+
+						# Google only returns a refresh token the first time a user consents. Keep the stored one,
+						# otherwise the new credentials stop working when the access token expires.
+						if not credentials.refresh_token:
+							stored = storage.get()
+							if stored is not None and stored.refresh_token:
+								credentials.refresh_token = stored.refresh_token
+
+						if credentials.refresh_token:
+							storage.put(credentials)
+							print ('Storing credentials to ', credential_path)
+
+					if credentials.refresh_token:
+						calendarBreaker.reset(new_calendar)
+						syncRequests.put(new_calendar)
+
+						message = 'Calendar already exists: ' + new_calendar + '. Credentials updated.'
+					else:
+						logger.warning ('Google Calendar: %s Re-authorization returned no refresh token. Credentials not updated.', new_calendar)
+						message = 'Calendar already exists: ' + new_calendar + '. Google did not return a refresh token, so the credentials were not updated. Remove this application\'s access from your Google account and try again.'
 				
 			except Exception as e:
 				logger.error('An error occurred: %s', e)
@@ -899,7 +2541,7 @@ class testHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 		else:
 			message = 'Union College Slate-Google Calendar Sync. Please log in to Slate to set up the sync.'
 
-		self.send_response(200)
+		self.send_response(status)
 		self.send_header('Content-type', 'text/html')
 		self.send_header('Cache-Control', 'no-cache')
 		self.end_headers()
@@ -908,8 +2550,95 @@ class testHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 		self.wfile.write(bytes(message, "utf8"))  
   
 		return
+
+	# POST
+	def do_POST(self):
+		# Notifications and triggers do not have a body, but drain anything that was sent
+		length = int(self.headers.get('Content-Length', 0))
+		if length > 0:
+			self.rfile.read(length)
+
+		if self.path.startswith('/trigger'):
+			parameters = (urllib.parse.parse_qs(urlparse(self.path).query))
+			status, message = self.triggerSync(parameters)
+			
+			self.send_response(status)
+			self.send_header('Content-type', 'text/plain')
+			self.send_header('Cache-Control', 'no-cache')
+			self.end_headers()
+			self.wfile.write(bytes(message, "utf8"))
+			return
+
+		elif self.path.startswith('/notifications'):
+			# Google Calendar push notification
+			channelId = self.headers.get('X-Goog-Channel-ID', '')
+			token = self.headers.get('X-Goog-Channel-Token', '')
+			state = self.headers.get('X-Goog-Resource-State', '')
+
+			calendar = findWatchChannelCalendar(channelId, token)
+			if calendar is None:
+				logger.warning ('Push notification received for unknown channel: %s', channelId)
+			elif state == 'sync':
+				logger.debug ('Google Calendar: %s Push notification channel %s confirmed', calendar, channelId)
+			else:
+				logger.info ('Google Calendar: %s Push notification received. Queueing calendar for sync.', calendar)
+				syncRequests.put(calendar, syncRequestWindow, notification=True)
+
+			self.send_response(200)
+		else:
+			self.send_response(404)
+
+		self.end_headers()
+		return
+
+	def triggerSync(self, parameters):
+		'''Queues a calendar for an on-demand sync. Returns the HTTP status and message.'''
+		if triggerToken == '':
+			return 404, 'Sync trigger is not enabled.'
+		
+		# The token is only accepted as a bearer token. Request paths are printed and logged, so it can't be a parameter.
+		token = ''
+		authorization = self.headers.get('Authorization', '')
+		if authorization.startswith('Bearer '):
+			token = authorization[len('Bearer '):].strip()
+		
+		if not secrets.compare_digest(token.encode('utf8'), triggerToken.encode('utf8')):
+			logger.warning ('Sync trigger rejected. Invalid token received from %s', self.client_address[0])
+			return 401, 'Not authorized.'
+		
+		if 'calendar' not in parameters:
+			return 400, 'No calendar specified.'
+		
+		calendar = parameters['calendar'][0].strip()
+		if not calendarExists(calendar):
+			return 404, 'Calendar does not exist: ' + html.escape(calendar)
+		
+		if syncRequests.put(calendar, syncRequestWindow):
+			logger.info ('Sync trigger received. Queueing calendar %s for sync.', calendar)
+			return 202, 'Sync queued for calendar ' + html.escape(calendar)
+		else:
+			logger.debug ('Sync trigger received. Calendar %s is already queued.', calendar)
+			return 202, 'Sync already queued for calendar ' + html.escape(calendar)
 			
 
+def triggerRunningSync(calendar):
+	'''Asks the running sync server to sync a calendar. Returns False if the server is not running.'''
+	import requests
+	
+	try:
+		r = requests.post('http://localhost:' + str(syncServerPort) + '/trigger', params={'calendar': calendar}, headers={'Authorization': 'Bearer ' + triggerToken}, timeout=15)
+	except requests.exceptions.ConnectionError:
+		return False
+	except requests.exceptions.RequestException as e:
+		# The server is running but busy. It handles one request at a time.
+		logger.error ('Could not send sync of calendar %s to running sync server. Exception: %s', calendar, e)
+		print ('The running sync server did not answer. Try again later.', e)
+		return True
+	
+	logger.info ('Sync of calendar %s sent to running sync server. HTTP Status Code: %s', calendar, r.status_code)
+	print (r.text)
+	return True
+
 def web():
 	print('starting server...')
  
@@ -919,24 +2648,53 @@ def web():
 	print('running server...')
 	httpd.serve_forever()			
 
+def runSync(syncCalendars=None):
+	global cProfilePending
+	try:
+		if cProfilePending and syncCalendars is None:
+			cProfilePending = False
+			profileCycle()
+		else:
+			main(syncCalendars)
+	except Exception as e:
+		logger.error ('Sync: Unhandled exception during sync.')
+		logger.exception(e)
+
 def sync():
 
-	t_sync = threading.Thread(target=main)
-	t_sync.daemon = False
-	t_sync.start()
+	# With push notifications changes are synced as they happen, so full syncs are only a safety net
+	if pushNotifications:
+		fullSyncInterval = safetySyncInterval
+	else:
+		fullSyncInterval = syncInterval
 
-	while True:
-		time.sleep (syncInterval)
+	# Finish changes interrupted by a crash before anything else is synced
+	try:
+		replayJournal()
+	except Exception as e:
+		logger.error ('Journal: Unhandled exception while finishing interrupted changes.')
+		logger.exception(e)
 
-		if t_sync.is_alive():
-			logger.warning ('Sync: Prior thread still running. Do not kick off another sync.')
-		else:
-			t_sync = threading.Thread(target=main)
-			t_sync.daemon = False
-			t_sync.start()
+	nextFullSync = time.time()
+
+	while True:
+		# Sync queued calendars until the next full sync is due
+		queued = syncRequests.get(max(0, nextFullSync - time.time()))
+		
+		# Calendars queued by push notifications are only synced if someone else changed a Slate event
+		queued = [calendar for calendar, notified in queued if not notified or slateEventsChanged(calendar)]
+		if queued:
+			logger.info ('Sync: Syncing queued calendars: %s', queued)
+			runSync(queued)
+
+		if time.time() >= nextFullSync:
+			nextFullSync = time.time() + fullSyncInterval
+			runSync()
 			
 if __name__ == '__main__':
 
+	init()
+	
 	# Create lock object
 	lock = threading.Lock()
 		
@@ -949,31 +2707,39 @@ if __name__ == '__main__':
 		
 	# Check to see if we need to clear out all Slate events on a calendar
 	if flags.clear is not None:
-		windowBegin = date.today() - timedelta(days=1000)
-		windowEnd = date.today() + timedelta(days=1000)
-	
 		clear_calendar = (flags.clear).strip()
 		logger.info ('Clearing all events from: %s', clear_calendar)
 		
 		if clear_calendar in calendars:
 			
-			credentials = getGoogleCredentials(clear_calendar, credential_dir)
-			http = credentials.authorize(httplib2.Http())
-			service = discovery.build('calendar', 'v3', http=http)
-			
-			googleEvents = readGoogleCalendar(service, clear_calendar, windowBegin, windowEnd)
-		
-			for event, eventDetails in googleEvents.items():
-				deleteEvent(service, googleApiBackoff, clear_calendar, eventDetails['eventId'])
-			
-			logger.info ('Calendar %s has been cleared.', clear_calendar)
-			print ('Calendar ', clear_calendar, ' has been cleared.')
+			if clearCalendar(clear_calendar):
+				logger.info ('Calendar %s has been cleared.', clear_calendar)
+				print ('Calendar ', clear_calendar, ' has been cleared.')
 		else:
 			logger.info ('Calendar %s does not exist.', clear_calendar)
 			print ('Calendar ', clear_calendar, ' does not exist.')
 		
 		sys.exit()
 		
+	# Check to see if we need to plan a sync without making any changes
+	if flags.plan is not None:
+		plan_calendar = (flags.plan).strip()
+		
+		if plan_calendar == '':
+			writePlan(main(planOnly=True), flags.plan_file)
+		elif plan_calendar in calendars:
+			writePlan(main([plan_calendar], planOnly=True), flags.plan_file)
+		else:
+			logger.info ('Calendar %s does not exist.', plan_calendar)
+			print ('Calendar ', plan_calendar, ' does not exist.')
+		
+		sys.exit()
+	
+	# If the sync server is already running hand a single calendar sync to it
+	if flags.sync is not None and triggerToken != '':
+		if triggerRunningSync((flags.sync).strip()):
+			sys.exit()
+		
 	# Start Web Server	
 	t_web = threading.Thread(target=web)
 	t_web.daemon = True
@@ -0,0 +1,96 @@
+'''
+	Slate - Google Calendar Sync
+	Push notification stand-in
+
+	Plays the part of Google Calendar push notifications so /notifications can be tested locally, where Google
+	won't deliver them. register saves a fake channel for a calendar to checkpoints/watch_channels.json. Run it while
+	slatesync.py is stopped, because the running program rewrites that file. When slatesync.py starts it loads the
+	channel and keeps using it until it is close to expiring. send posts notifications for a calendar using the
+	channel id and token saved in that file.
+
+	Usage:
+		python tools/push_notify.py register email_address [--ttl 604800]
+		python tools/push_notify.py send email_address [--url http://localhost:8080/notifications] [--state exists] [--count 1]
+'''
+
+import argparse
+import json
+import os
+import secrets
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+WATCH_CHANNEL_FILE = os.path.join(REPO_DIR, 'checkpoints', 'watch_channels.json')
+
+def loadChannels():
+	if not os.path.isfile(WATCH_CHANNEL_FILE):
+		return {}
+	with open(WATCH_CHANNEL_FILE, 'r') as f:
+		return json.load(f)
+
+def register(calendar, ttl):
+	channels = loadChannels()
+	channels[calendar] = {
+		'id'			: 'local-' + str(uuid.uuid4()),
+		'resourceId'	: 'local',
+		'token'			: secrets.token_urlsafe(24),
+		'expiration'	: time.time() + ttl,
+	}
+
+	os.makedirs(os.path.dirname(WATCH_CHANNEL_FILE), exist_ok=True)
+	fd = os.open(WATCH_CHANNEL_FILE + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	with os.fdopen(fd, 'w') as f:
+		json.dump(channels, f, indent=4, sort_keys=True)
+	os.replace(WATCH_CHANNEL_FILE + '.tmp', WATCH_CHANNEL_FILE)
+
+	print('Registered channel', channels[calendar]['id'], 'for calendar', calendar)
+
+def send(calendar, url, state, count):
+	channel = loadChannels().get(calendar)
+	if channel is None:
+		print('No push notification channel saved for calendar', calendar)
+		return False
+
+	for number in range(1, count + 1):
+		# The headers Google sends with a push notification. Notifications have no body.
+		request = urllib.request.Request(url, data=b'', method='POST', headers={
+			'X-Goog-Channel-ID'		: channel['id'],
+			'X-Goog-Channel-Token'	: channel['token'],
+			'X-Goog-Resource-ID'	: channel['resourceId'],
+			'X-Goog-Resource-State'	: state,
+			'X-Goog-Message-Number'	: str(number),
+		})
+		try:
+			with urllib.request.urlopen(request, timeout=15) as response:
+				print('Notification', number, 'for', calendar, '- HTTP Status Code:', response.status)
+		except urllib.error.URLError as e:
+			print('Could not post notification to', url, '-', e)
+			return False
+
+	return True
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Slate - Google Calendar Sync push notification stand-in')
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+
+	registerParser = subparsers.add_parser('register', help='Save a fake push notification channel for a calendar')
+	registerParser.add_argument('calendar', metavar='email_address')
+	registerParser.add_argument('--ttl', type=int, default=604800, help='Seconds until the channel expires (default: 604800)')
+
+	sendParser = subparsers.add_parser('send', help='Post push notifications for a calendar')
+	sendParser.add_argument('calendar', metavar='email_address')
+	sendParser.add_argument('--url', default='http://localhost:8080/notifications', help='Notification address (default: http://localhost:8080/notifications)')
+	sendParser.add_argument('--state', default='exists', choices=['sync', 'exists', 'not_exists'], help='Resource state to send (default: exists)')
+	sendParser.add_argument('--count', type=int, default=1, help='Number of notifications to post (default: 1)')
+
+	flags = parser.parse_args()
+
+	if flags.command == 'register':
+		register(flags.calendar, flags.ttl)
+	elif not send(flags.calendar, flags.url, flags.state, flags.count):
+		sys.exit(1)